@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+from config import config
+
+# Bound at import, since reliability_guard later disables it in the improver process
+replace_file = os.replace
+
+class BlobStore:
+    def __init__(self, root="blobs"):
+        """
+        Content-addressed store of text artifacts (prompts, responses, algorithms), shared by all processes using the same root.
+
+        Each distinct text is written once, compressed, to root/<hash[:2]>/<hash[2:]>, so repeated artifacts
+        like the base algorithm of every meta-utility test cost a row in the index instead of a file.
+        The index (root/index.sqlite) maps runs, iterations, tests and prompts to blobs, to look up past generations.
+
+        Args:
+            root (str): The directory of the blobs and the index.
+        """
+        self.root = root
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        """Opens the index, once per process (connections can't be shared across forks)."""
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        os.makedirs(self.root, exist_ok=True)
+        connection = sqlite3.connect(
+            os.path.join(self.root, "index.sqlite"), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts (kind TEXT, hash TEXT, parent TEXT, run_id TEXT, iteration INTEGER, "
+            "test_idx INTEGER, name TEXT, metadata TEXT, created REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id, kind, iteration)")
+        connection.execute("CREATE INDEX IF NOT EXISTS artifacts_parent ON artifacts (parent)")
+        self.connection = connection
+        self.pid = os.getpid()
+        return connection
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:])
+
+    def put(self, text):
+        """Stores the text, unless it is already stored, and returns its hash."""
+        data = text.encode()
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(blob_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name, so that other processes never see a partial blob
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as writer:
+                writer.write(zlib.compress(data))
+            replace_file(temp_path, path)
+        return blob_hash
+
+    def get(self, blob_hash):
+        with open(self.blob_path(blob_hash), "rb") as reader:
+            return zlib.decompress(reader.read()).decode()
+
+    def record(self, kind, text, parent=None, run_id=None, iteration=None, test_idx=None, name=None, metadata=None):
+        """
+        Stores the text and indexes it as an artifact.
+
+        Args:
+            kind (str): What the artifact is, e.g. "prompt", "response", "base_algorithm" or "improved_algorithm".
+            text (str): The artifact.
+            parent (str): The hash of the artifact it derives from, e.g. the prompt of a response.
+            run_id, iteration, test_idx: Where in a run it was made, if known.
+            name (str): A name within the run, like the file name it used to be saved as.
+            metadata (dict): Anything else to keep with it, e.g. its utility.
+
+        Returns:
+            blob_hash (str): The hash of the text.
+        """
+        blob_hash = self.put(text)
+        with self.lock:
+            self.connect().execute(
+                "INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, blob_hash, parent, run_id, iteration, test_idx, name,
+                 json.dumps(metadata) if metadata is not None else None, time.time()),
+            )
+        return blob_hash
+
+    def find(self, kind=None, run_id=None, iteration=None, test_idx=None, parent=None):
+        """Returns the index rows (as dicts, oldest first) of the artifacts matching every given field."""
+        filters = {"kind": kind, "run_id": run_id, "iteration": iteration, "test_idx": test_idx, "parent": parent}
+        filters = {column: value for column, value in filters.items() if value is not None}
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+        with self.lock:
+            cursor = self.connect().execute(
+                f"SELECT * FROM artifacts WHERE {where} ORDER BY created", tuple(filters.values())
+            )
+            columns = [description[0] for description in cursor.description]
+            rows = cursor.fetchall()
+        artifacts = [dict(zip(columns, row)) for row in rows]
+        for artifact in artifacts:
+            if artifact["metadata"] is not None:
+                artifact["metadata"] = json.loads(artifact["metadata"])
+        return artifacts
+
+blob_store = BlobStore(config['blob_store_dir'])
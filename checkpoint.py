@@ -0,0 +1,41 @@
+import os
+import pickle
+from instance_bank import capture_random_states, restore_random_states
+
+# Bound at import, since reliability_guard later disables it in the improver process
+replace_file = os.replace
+
+CHECKPOINT_VERSION = 1
+
+def checkpoint_path(run_id):
+    return f"results/{run_id}/checkpoint.pkl"
+
+def save_checkpoint(run_id, state):
+    """
+    Atomically replaces the run's checkpoint with state, plus the current random and np.random states:
+    it is written and synced under a temporary name first, so a crash leaves the previous checkpoint intact.
+    """
+    path = checkpoint_path(run_id)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    checkpoint = {"version": CHECKPOINT_VERSION, "random_states": capture_random_states(), **state}
+    with open(temp_path, "wb") as writer:
+        pickle.dump(checkpoint, writer)
+        writer.flush()
+        os.fsync(writer.fileno())
+    replace_file(temp_path, path)
+
+def load_checkpoint(run_id):
+    """
+    Returns the run's latest checkpoint, after restoring the random states saved with it,
+    or None if the run has no checkpoint (e.g. it was started before checkpoints existed).
+    """
+    path = checkpoint_path(run_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as reader:
+        checkpoint = pickle.load(reader)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        print("Ignoring checkpoint with version", checkpoint.get("version"))
+        return None
+    restore_random_states(checkpoint.pop("random_states"))
+    return checkpoint
@@ -10,11 +10,48 @@ config = {
     "n_iterations": 6,
     'use_language_model_cache': False,
     'max_responses_per_call': n,
+    'language_model_requests_per_second': 2,
+    'language_model_tokens_per_minute': 40000,
+    'language_model_coalesce_window': 0.05,
+    'language_model_max_coalesced_responses': 5,
+    'language_model_backend': 'openai',  # 'openai' or 'local' (see lm_backend.LocalBackend)
+    'local_backend_mode': 'template',  # 'replay', 'template' or 'http'
+    'local_backend_template': "Here is an improved solution.\n```python\n{code}\n```",
+    'local_backend_url': 'http://localhost:8000/v1',
+    'local_backend_latency': 0.0,
+    'local_backend_chunk_latency': 0.0,
+    'local_backend_error_rate': 0.0,
+    'local_backend_rate_limit_error_rate': 0.0,
     'language_model_call_budget': m,
     'meta_utility_budget': n * m + 1,
     'utility_budget': n * m + 1,
     'meta_utility_tests': 5,
+    'meta_utility_parallel': False,
     'transfer_eval_type': 'improved',
     'use_timeout_in_improver': False,
+    'use_bytecode_cache': False,
+    'compiled_code_cache_size': 256,
+    'instance_bank_dir': 'instance_banks',
+    'worker_pool_size': None,
+    'worker_max_memory_bytes': 2 * 1024 ** 3,
+    'worker_deadline_factor': 3,
+    'sandbox_workers': True,
+    'worker_memory_limit_bytes': 8 * 1024 ** 3,
+    'worker_cpu_limit_seconds': 60,
+    'use_utility_memo': False,
+    'utility_memo_path': 'cache/utility_memo.sqlite',
+    'usage_log_path': 'usage_log.jsonl',
+    'usage_log_prompt_dir': 'usage_log_prompts',
+    'usage_log_flush_interval': 1.0,
+    'usage_log_max_bytes': 64 * 1024 ** 2,
+    'usage_log_max_age': 24 * 60 * 60,
+    'usage_log_compress': True,
+    'blob_store_dir': 'blobs',
+    'population_size': None,  # Number of lineages for run_improver's population mode, or None for a single lineage
+    'population_selection': 'top_k',  # 'top_k' or 'tournament'
+    'population_tournament_size': 2,
+    'population_workers': None,
+    'population_meta_utility_budget': None,
+    'population_language_model_budget': None,
     'join_pools': False,
 }
\ No newline at end of file
@@ -1,77 +1,240 @@
 from language_model import LanguageModel
 import os
+import re
+import ast
 import time
+import sys
+import queue
+import asyncio
+import threading
+import types
+import marshal
+import hashlib
+import collections
+import contextlib
+import numpy as np
+import linecache
 import traceback
-import importlib
 import platform
 import faulthandler
+from concurrent.futures import ThreadPoolExecutor
+from config import config
+from worker_pool import worker_pool
+from blob_store import blob_store
+from telemetry import registry
 
-def extract_code(algorithm_str):
+# A fence line: up to three spaces, three backticks, then an optional language tag and whatever follows it
+CODE_FENCE = re.compile(r"^ {0,3}```[ \t]*([^\s`]*)[^\n]*$", re.MULTILINE)
+PYTHON_TAGS = ("python", "python3", "py", "")
+
+def extract_code(algorithm_str, policy="largest", base_name=None):
+    """
+    Returns the code of the block of a response chosen by policy (see select_code_block), or None if it has none.
+    Also takes a list of responses, and returns the code of each.
+    """
     if isinstance(algorithm_str, str):
-        # If the result is wrapped in triple backticks, remove the first and last lines
-        return find_largest_code_block_line_by_line(algorithm_str)
+        return select_code_block(find_code_blocks(algorithm_str), policy, base_name)
     elif isinstance(algorithm_str, list):
-        extracted_codes = [extract_code(algorithm_str) for algorithm_str in algorithm_str]
+        extracted_codes = [extract_code(algorithm_str, policy, base_name) for algorithm_str in algorithm_str]
         return extracted_codes
 
 def find_largest_code_block_line_by_line(text):
-    largest_block = ""
-    current_block = ""
-    nesting_level = 0  # To keep track of the level of nesting
-
-    lines = text.split("\n")
-    
-    for line in lines:
-        if line.startswith("```"):  # We've found a block delimiter
-            if not line[3:].strip():  # If it's a closing delimiter
-                nesting_level -= 1  # Decrease the nesting level
-                
-                if nesting_level == 0:  # We've closed the outermost block
-                    current_block += line + "\n"  # Add the line to the current block
-                    
-                    # Compare the length of the current block with the largest block found so far
-                    if len(current_block) > len(largest_block):
-                        largest_block = current_block
-                    
-                    current_block = ""  # Reset the current block
-                else:
-                    current_block += line + "\n"  # Add the line to the current block
-            else:  # It's an opening delimiter
-                current_block += line + "\n"  # Add the line to the current block
-                nesting_level += 1  # Increase the nesting level
+    return select_code_block(find_code_blocks(text))
+
+class CodeBlock:
+    def __init__(self, language, text, start, end, closed):
+        """
+        A fenced code block of a response.
+
+        Args:
+            language (str): The tag after the opening fence, lowercased, or "" if it has none.
+            text (str): The response the block is in.
+            start (int): The offset in text of the first line of code, after the opening fence.
+            end (int): The offset in text of the closing fence (or the end of text, if the block wasn't closed).
+            closed (bool): Whether the block was closed.
+        """
+        self.language = language
+        self.start = start
+        self.end = end
+        self.closed = closed
+        # Without the newline before the closing fence
+        self.code = text[start:max(end - 1, start)]
+
+    def defines(self, base_name):
+        """Returns whether the block has a top-level definition of base_name."""
+        return re.search(rf"^(?:async\s+def|def|class)\s+{re.escape(base_name)}\b|^{re.escape(base_name)}\s*=",
+                         self.code, re.MULTILINE) is not None
+
+class CodeBlockParser:
+    def __init__(self):
+        """
+        The fence nesting rules of find_code_blocks, fed one fence line at a time: outside of a block any fence
+        opens one; inside, a bare fence closes the innermost open block, and a tagged fence opens a nested one,
+        which stays part of the outermost block. Blocks are only kept at the outermost level.
+        """
+        self.closed_blocks = []  # The languages and offsets of the closed blocks
+        self.open_blocks = []  # The languages and code offsets of the open blocks, outermost first
+
+    def fence(self, info, line_start, line_end):
+        """Processes a fence line spanning text[line_start:line_end], with info the tag after the backticks."""
+        if self.open_blocks and not info:
+            language, start = self.open_blocks.pop()
+            if not self.open_blocks:
+                self.closed_blocks.append((language, start, line_start))
+        else:
+            self.open_blocks.append((info.lower(), line_end + 1))
+
+    def blocks(self, text):
+        """Returns the blocks of text, the whole text fed so far, including the outermost open block, if any, as unclosed."""
+        blocks = [CodeBlock(language, text, start, end, True) for language, start, end in self.closed_blocks]
+        if self.open_blocks:
+            language, start = self.open_blocks[0]
+            blocks.append(CodeBlock(language, text, min(start, len(text)), len(text) + 1, False))
+        return blocks
+
+def find_code_blocks(text):
+    """
+    Returns the fenced code blocks of a response, outermost only and in order, in one pass over its fence lines.
+    Unlike the fences of Markdown renderers, a fence with a language tag inside a block opens a nested block,
+    so that code blocks quoted in a block (e.g. in a prompt it builds) stay in it.
+    """
+    parser = CodeBlockParser()
+    for fence in CODE_FENCE.finditer(text):
+        parser.fence(fence.group(1), fence.start(), fence.end())
+    return parser.blocks(text)
+
+def select_code_block(blocks, policy="largest", base_name=None):
+    """
+    Returns the code of the closed block chosen by policy, or None if there is none:
+        "largest": the largest block (the first, if tied).
+        "last_python": the last block tagged as Python or untagged.
+        "defines": the largest block defining base_name at the top level.
+    If no block matches "last_python" or "defines", falls back to "largest".
+    """
+    blocks = [block for block in blocks if block.closed and block.code.strip()]
+    candidates = blocks
+    if policy == "last_python":
+        candidates = [block for block in blocks if block.language in PYTHON_TAGS][-1:]
+    elif policy == "defines" and base_name is not None:
+        candidates = [block for block in blocks if block.defines(base_name)]
+    elif policy != "largest" and policy != "defines":
+        raise Exception(f"Unknown code block policy {policy}")
+    candidates = candidates or blocks
+    if not candidates:
+        return None
+    return max(candidates, key=lambda block: len(block.code)).code
+
+class CodeBlockTracker:
+    def __init__(self):
+        """
+        Finds the code blocks of a text fed a piece at a time, e.g. as a completion streams in,
+        with the same rules (and result) as find_code_blocks. Also keeps the statistics is_off_the_rails looks at.
+        """
+        self.pieces = []
+        self.parser = CodeBlockParser()
+        self.partial_line = ""
+        self.line_start = 0
+        self.n_chars = 0
+        self.opened_block = False
+        self.last_line = None
+        self.n_repeated_lines = 0
+
+    def feed(self, text):
+        self.n_chars += len(text)
+        self.pieces.append(text)
+        lines = (self.partial_line + text).split("\n")
+        # The last line may continue in the next piece
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.add_line(line)
+
+    def add_line(self, line):
+        if line.strip() and line == self.last_line:
+            self.n_repeated_lines += 1
         else:
-            if nesting_level > 0:  # If we're inside a block
-                current_block += line + "\n"  # Add the line to the current block
-
-    if largest_block:
-        # Remove the first and last lines (the outermost backticks)
-        largest_block = "\n".join(largest_block.strip().split("\n")[1:-1])
-
-    return largest_block if largest_block else None
-
-def run_by_creating_file(define_fn_str, base_name):
-    # Create a file with the define_fn_str
-    timestamp = str(time.time()).replace(".", "")
-    # Make the temp directory if it doesn't exist
-    os.makedirs("temp", exist_ok=True)
-    write_str_to_file(define_fn_str, f"temp/{base_name}_{timestamp}.py")
-    # Import the file
-    imported = False
-    attempts = 0
-    while not imported and attempts < 10:
+            self.n_repeated_lines = 0
+        self.last_line = line
+        line_end = self.line_start + len(line)
+        fence = CODE_FENCE.match(line)
+        if fence:
+            self.parser.fence(fence.group(1), self.line_start, line_end)
+            self.opened_block = self.opened_block or bool(self.parser.open_blocks)
+        self.line_start = line_end + 1
+
+    def blocks(self):
+        """Returns the code blocks of the text fed so far (see find_code_blocks)."""
+        return self.parser.blocks("".join(self.pieces))
+
+    def finish(self, policy="largest", base_name=None):
+        """Processes the rest of the text and returns the code of the block chosen by policy, or None."""
+        self.add_line(self.partial_line)
+        self.partial_line = ""
+        return select_code_block(self.blocks(), policy, base_name)
+
+def is_off_the_rails(tracker, max_chars_without_code=2000, max_repeated_lines=20):
+    """
+    Returns whether a streaming completion is unlikely to produce useful code: it has gone on for
+    max_chars_without_code characters without opening a code block, or is repeating the same line.
+    """
+    if not tracker.opened_block and tracker.n_chars > max_chars_without_code:
+        return True
+    return tracker.n_repeated_lines >= max_repeated_lines
+
+# The most recently used code objects, by source hash, up to config['compiled_code_cache_size']
+compiled_code_cache = collections.OrderedDict()
+
+def compile_source(define_fn_str, base_name):
+    """
+    Compiles a source string, caching the code object in-process by the SHA-256 of the source
+    and, if config['use_bytecode_cache'] is set, on disk under temp/bytecode.
+    The source is registered with linecache so that tracebacks still show the offending lines.
+    The in-process cache keeps the most recently used sources only, so long runs and persistent workers
+    don't accumulate every candidate they have seen.
+    """
+    source_hash = hashlib.sha256(define_fn_str.encode()).hexdigest()
+    if source_hash in compiled_code_cache:
+        compiled_code_cache.move_to_end(source_hash)
+        return compiled_code_cache[source_hash][1]
+    filename = f"<temp/{base_name}_{source_hash[:16]}.py>"
+    linecache.cache[filename] = (len(define_fn_str), None, define_fn_str.splitlines(True), filename)
+    bytecode_path = f"temp/bytecode/{source_hash}.{sys.implementation.cache_tag}.bin"
+    code = None
+    if config['use_bytecode_cache'] and os.path.exists(bytecode_path):
         try:
-            importlib.invalidate_caches()
-            module = importlib.import_module(f"temp.{base_name}_{timestamp}")
-            imported = True
-        except ModuleNotFoundError as e:
-            print("Module not found, trying again")
-            print("Exception:", e)
-            time.sleep(0.1)
-            attempts += 1
+            with open(bytecode_path, "rb") as f:
+                code = marshal.load(f)
         except Exception as e:
-            print("Failed to import module with exception", e)
-            print(traceback.format_exc())
-            raise e
+            # Possibly a partially written file from a concurrent process
+            print("Failed to load bytecode cache with exception", e)
+    if code is None:
+        try:
+            code = compile(define_fn_str, filename, "exec")
+        except Exception:
+            linecache.cache.pop(filename, None)
+            raise
+        if config['use_bytecode_cache']:
+            os.makedirs("temp/bytecode", exist_ok=True)
+            try:
+                with open(bytecode_path, "xb") as f:
+                    marshal.dump(code, f)
+            except FileExistsError:
+                pass
+    compiled_code_cache[source_hash] = (filename, code)
+    while len(compiled_code_cache) > config['compiled_code_cache_size']:
+        evicted_filename, _ = compiled_code_cache.popitem(last=False)[1]
+        linecache.cache.pop(evicted_filename, None)
+    return code
+
+def run_by_compiling(define_fn_str, base_name):
+    """
+    Defines the function base_name from define_fn_str in a fresh module namespace, without a filesystem round trip.
+    The module-level code is re-run on every call, so no state carries over between overrides.
+    """
+    code = compile_source(define_fn_str, base_name)
+    module_name = f"temp_{base_name}_{hashlib.sha256(define_fn_str.encode()).hexdigest()[:16]}"
+    module = types.ModuleType(module_name)
+    # Not registered in sys.modules, which would keep every candidate's module alive for the rest of the process
+    exec(code, module.__dict__)
     # Get the function
     fn = getattr(module, base_name)
     return fn
@@ -151,9 +314,41 @@ def reliability_guard(maximum_memory_bytes = None):
     sys.modules['psutil'] = None
     sys.modules['tkinter'] = None
 
-def temp_override(define_fn_str, base_name, update_globals=True, use_sandbox=True, strict_sandbox=True):
+# Audit events (see sys.addaudithook) that candidates in sandboxed workers must not raise
+SANDBOX_BLOCKED_EVENTS = {
+    "os.system", "os.exec", "os.posix_spawn", "os.spawn", "os.fork", "os.forkpty", "os.kill", "os.killpg",
+    "os.remove", "os.rmdir", "os.rename", "os.truncate", "os.chmod", "os.chown", "os.chdir", "os.link", "os.symlink",
+    "os.putenv", "os.unsetenv", "shutil.rmtree", "subprocess.Popen", "socket.connect", "socket.bind", "socket.sendto",
+    "resource.setrlimit", "resource.prlimit", "sys.addaudithook",
+}
+WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+
+def install_audit_hook(allowed_write_dirs=("temp",)):
+    """
+    Makes this process raise PermissionError on the audit events of SANDBOX_BLOCKED_EVENTS and on opening files
+    for writing outside allowed_write_dirs. Unlike reliability_guard, which only replaces Python functions,
+    this also catches the same operations reached through aliases or C modules (e.g. posix.kill), and it can't be undone:
+    it has no off switch, so limits that must change per call are enforced from outside (see worker_pool.manager_main).
+    """
+    allowed_prefixes = tuple(os.path.join(directory, "") for directory in allowed_write_dirs)
+
+    def audit_hook(event, args):
+        if event in SANDBOX_BLOCKED_EVENTS:
+            raise PermissionError(f"{event} is not allowed in the sandbox")
+        if event == "open" and isinstance(args[0], str):
+            path, mode, flags = args
+            is_write = any(char in mode for char in "wax+") if isinstance(mode, str) else bool(flags & WRITE_FLAGS)
+            if is_write and not os.path.normpath(path).startswith(allowed_prefixes):
+                raise PermissionError(f"Writing to {path} is not allowed in the sandbox")
+
+    sys.addaudithook(audit_hook)
+
+def temp_override(define_fn_str, base_name, update_globals=True, use_sandbox=True, strict_sandbox=True, in_worker=False):
     """
     Overrides a function temporarily.
+    With in_worker, for candidates that are only ever called through worker_pool, the function is defined in a
+    sandboxed worker instead (see WorkerPool.define) and None is returned, so this process doesn't run any of
+    the candidate's code and isn't put under reliability_guard.
     """
     if define_fn_str is None:
         raise Exception("define_fn_str is None in temp_override")
@@ -170,7 +365,10 @@ def temp_override(define_fn_str, base_name, update_globals=True, use_sandbox=Tru
                     raise Exception("Aborting due to sandbox warning")
                 else:
                     write_str_to_file("", "acknowledge_strict_sandbox.txt")
-            reliability_guard()
+            # Candidates run in the worker pool, whose processes can't be forked once the guard is in place
+            worker_pool.start(guard_workers=True)
+            if not in_worker:
+                reliability_guard()
         else:
             if not os.path.exists("acknowledge_unsafe.txt"):
                 print("WARNING: You are using temp_override without a strict sandbox. This is particularly unsafe and may cause your computer to crash.")
@@ -180,17 +378,618 @@ def temp_override(define_fn_str, base_name, update_globals=True, use_sandbox=Tru
                 else:
                     write_str_to_file("", "acknowledge_unsafe.txt")
                 
+    if in_worker:
+        worker_pool.define(define_fn_str, base_name)
+        return None
 
     new_globals = globals().copy()
     if base_name in new_globals:
         del new_globals[base_name]
-    new_fn = run_by_creating_file(define_fn_str, base_name)  # Useful for debugging
+    new_fn = run_by_compiling(define_fn_str, base_name)
     if base_name in new_globals:
         del new_globals[base_name]
     if update_globals:
         globals().update(new_globals)
     return new_fn
 
+rejected_candidates_total = registry.counter(
+    "rejected_candidates_total", "Candidates rejected by screen_candidate before being evaluated, by reason"
+)
+duplicate_candidates_total = registry.counter(
+    "duplicate_candidates_total", "Candidates scored in place of an earlier one with the same AST fingerprint"
+)
+near_duplicate_candidates_total = registry.counter(
+    "near_duplicate_candidates_total", "Candidates differing from an earlier one only in their constants"
+)
+
+def fingerprint_candidate(tree, keep=()):
+    """
+    Fingerprints a parsed candidate (modifying the tree): docstrings are dropped, and the names it binds, except keep,
+    are renamed $0, $1, ... in order of first binding, so programs differing only in names, comments, docstrings
+    or formatting get the same fingerprint. Names it only reads, like builtins and imported modules, are kept;
+    the placeholders can't clash with them, since they aren't valid identifiers. Keyword arguments are only renamed
+    in calls of functions and classes the candidate defines, when they name a parameter of that definition.
+
+    Returns:
+        fingerprint (str): The hash of the normalized source.
+        structure (str): The hash of the normalized source with every constant replaced by its type,
+        shared by near-duplicates, e.g. the same program with another step size.
+    """
+    renamed = {}
+    # The parameters of the functions and classes (those of their __init__) the candidate defines, by name
+    parameters = collections.defaultdict(set)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            definitions = [(node.name, node)]
+        elif isinstance(node, ast.ClassDef):
+            definitions = [
+                (node.name, method) for method in node.body
+                if isinstance(method, (ast.FunctionDef, ast.AsyncFunctionDef)) and method.name == "__init__"
+            ]
+        else:
+            definitions = []
+        for name, definition in definitions:
+            arguments = definition.args
+            parameters[name].update(arg.arg for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            name = node.id
+        elif isinstance(node, ast.arg):
+            name = node.arg
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.ExceptHandler)):
+            name = node.name
+        else:
+            continue
+        if name is not None and name not in keep:
+            renamed.setdefault(name, f"${len(renamed)}")
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            node.id = renamed.get(node.id, node.id)
+        elif isinstance(node, ast.arg):
+            node.arg = renamed.get(node.arg, node.arg)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in parameters:
+            # Walked before its children, so the callee still has its own name
+            for keyword in node.keywords:
+                if keyword.arg in parameters[node.func.id]:
+                    keyword.arg = renamed.get(keyword.arg, keyword.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            node.names = [renamed.get(name, name) for name in node.names]
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            node.name = renamed.get(node.name, node.name)
+        if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            if not isinstance(node, ast.Module):
+                node.name = renamed.get(node.name, node.name)
+            body = node.body
+            if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+                    and isinstance(body[0].value.value, str):
+                node.body = body[1:] or [ast.Pass()]
+    fingerprint = hashlib.sha256(ast.unparse(tree).encode()).hexdigest()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant):
+            node.value = type(node.value).__name__
+    structure = hashlib.sha256(ast.unparse(tree).encode()).hexdigest()
+    return fingerprint, structure
+
+class FingerprintTable:
+    def __init__(self):
+        """
+        The candidates a utility has screened during the run, by fingerprint (see fingerprint_candidate),
+        with the scores of those evaluated, so that each distinct program is scored once per run and mode.
+        Kept on the utility (as utility.fingerprints), since scores only carry over within the same utility.
+        """
+        self.lock = threading.Lock()
+        self.representatives = {}
+        self.structures = {}
+        self.scores = {}
+
+    def representative(self, fingerprints, algorithm_str):
+        """
+        Returns the first candidate seen with the same fingerprint (possibly algorithm_str itself),
+        and whether algorithm_str is a new near-duplicate: first seen now, but with the structure of an earlier candidate.
+        """
+        fingerprint, structure = fingerprints
+        with self.lock:
+            is_new = fingerprint not in self.representatives
+            representative = self.representatives.setdefault(fingerprint, algorithm_str)
+            first_fingerprint = self.structures.setdefault(structure, fingerprint)
+        return representative, is_new and first_fingerprint != fingerprint
+
+    def known_scores(self, algorithm_strs, mode):
+        with self.lock:
+            return {
+                algorithm_str: self.scores[algorithm_str, mode]
+                for algorithm_str in algorithm_strs if (algorithm_str, mode) in self.scores
+            }
+
+    def add_scores(self, scores, mode):
+        with self.lock:
+            for algorithm_str, score in scores:
+                self.scores[algorithm_str, mode] = score
+
+def screen_candidate(algorithm_str, base_name, n_args=None, banned_names=("ProcessPool",)):
+    """
+    Checks a candidate without running it, for the failures that would otherwise cost a compile and a utility use:
+    no code at all, a syntax error, no function base_name, a function that can't take n_args positional arguments,
+    or a banned name (like temp_override's filtered strings, but ignoring comments and strings).
+
+    Returns:
+        fingerprints (tuple): The fingerprint and structure of the candidate (see fingerprint_candidate), or None if rejected.
+        rejection (dict): None, or the reason ("no_code", "syntax_error", "missing_function", "bad_signature"
+        or "banned_name") with a human-readable detail.
+    """
+    if not isinstance(algorithm_str, str) or not algorithm_str.strip():
+        return None, {"reason": "no_code", "detail": f"Candidate is {algorithm_str!r:.40}"}
+    try:
+        tree = ast.parse(algorithm_str)
+    except (SyntaxError, ValueError) as e:
+        return None, {"reason": "syntax_error", "detail": f"Line {getattr(e, 'lineno', None)}: {getattr(e, 'msg', e)}"}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names = [node.id]
+        elif isinstance(node, ast.Attribute):
+            names = [node.attr]
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names = [name for alias in node.names for name in alias.name.split(".")]
+        else:
+            continue
+        for name in names:
+            if name in banned_names:
+                return None, {"reason": "banned_name", "detail": f"{name} is not supported (line {node.lineno})"}
+    # The last top-level binding of base_name is the one temp_override picks up
+    definition = None
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.name == base_name:
+            definition = node
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.Import, ast.ImportFrom)):
+            targets = node.targets if isinstance(node, ast.Assign) else [getattr(node, "target", None)]
+            bound = [target.id for target in targets if isinstance(target, ast.Name)]
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                bound = [(alias.asname or alias.name).split(".")[0] for alias in node.names]
+            if base_name in bound:
+                # Bound to something we can't check statically
+                definition = node
+    if definition is None:
+        return None, {"reason": "missing_function", "detail": f"No top-level definition of {base_name}"}
+    if isinstance(definition, ast.AsyncFunctionDef):
+        return None, {"reason": "bad_signature", "detail": f"{base_name} is async"}
+    if isinstance(definition, ast.FunctionDef) and n_args is not None:
+        arguments = definition.args
+        n_positional = len(arguments.posonlyargs) + len(arguments.args)
+        n_required = n_positional - len(arguments.defaults)
+        n_required_keywords = sum(default is None for default in arguments.kw_defaults)
+        if n_args < n_required or (n_args > n_positional and arguments.vararg is None) or n_required_keywords:
+            return None, {
+                "reason": "bad_signature",
+                "detail": f"{base_name}({ast.unparse(arguments)}) can't be called with {n_args} positional arguments",
+            }
+    return fingerprint_candidate(tree, keep=(base_name,)), None
+
+def screen_candidates(utility, algorithm_strs):
+    """
+    Screens candidates for utility (see screen_candidate), if it has a target, a (base_name, n_args) pair.
+    Returns a dict mapping each candidate to the candidate to score in its place: itself, the first candidate
+    this run with the same fingerprint, or None if it is rejected. Rejections and near-duplicates are printed,
+    and rejections and duplicates counted in telemetry.
+    """
+    target = getattr(utility, "target", None)
+    if target is None:
+        return {algorithm_str: algorithm_str for algorithm_str in algorithm_strs}
+    if getattr(utility, "fingerprints", None) is None:
+        utility.fingerprints = FingerprintTable()
+    representatives = {}
+    for algorithm_str in algorithm_strs:
+        if algorithm_str in representatives:
+            continue
+        fingerprints, rejection = screen_candidate(algorithm_str, *target)
+        if rejection is not None:
+            print(f"Rejected candidate ({rejection['reason']}): {rejection['detail']}")
+            rejected_candidates_total.inc(reason=rejection["reason"])
+            representatives[algorithm_str] = None
+            continue
+        representative, is_near_duplicate = utility.fingerprints.representative(fingerprints, algorithm_str)
+        if representative != algorithm_str:
+            duplicate_candidates_total.inc()
+        elif is_near_duplicate:
+            print("Near-duplicate candidate: it only differs from an earlier one in its constants")
+            near_duplicate_candidates_total.inc()
+        representatives[algorithm_str] = representative
+    return representatives
+
+def known_scores(utility, algorithm_strs, mode):
+    """Returns the scores, by candidate, of the candidates utility has already evaluated this run (see FingerprintTable)."""
+    fingerprints = getattr(utility, "fingerprints", None)
+    return fingerprints.known_scores(algorithm_strs, mode) if fingerprints is not None else {}
+
+def add_known_scores(utility, scores, mode):
+    fingerprints = getattr(utility, "fingerprints", None)
+    if fingerprints is not None:
+        fingerprints.add_scores(scores, mode)
+
+use_lock = threading.Lock()
+reserved_calls = threading.local()
+
+def reserve_uses(utility, n):
+    """
+    Takes up to n uses of utility.budget at once, like SharedBudget.take in language_model.py, so that concurrent
+    callers of the same utility can't spend the same uses. Returns how many were taken; give back the ones
+    that end up unused with refund_uses.
+    """
+    with use_lock:
+        uses = getattr(utility, "uses", 0)
+        n_taken = max(min(n, utility.budget - uses), 0)
+        utility.uses = uses + n_taken
+    return n_taken
+
+def refund_uses(utility, n):
+    with use_lock:
+        utility.uses -= n
+
+@contextlib.contextmanager
+def reserved_use(utility):
+    """Marks calls of utility from this thread, within the block, as using a use already taken with reserve_uses."""
+    previous = getattr(reserved_calls, "utilities", frozenset())
+    reserved_calls.utilities = previous | {utility}
+    try:
+        yield
+    finally:
+        reserved_calls.utilities = previous
+
+def count_use(utility):
+    """
+    Counts a call of a utility that counts its own uses against utility.budget. Returns False, without counting it,
+    if the budget is spent. Calls inside reserved_use(utility) are allowed without being counted again.
+    """
+    if utility in getattr(reserved_calls, "utilities", ()):
+        return True
+    return reserve_uses(utility, 1) == 1
+
+def batch_evaluate(utility, algorithm_strs, mode="val", max_parallel=None):
+    """
+    Scores several algorithms, like [utility(s, mode=mode) for s in algorithm_strs] but faster.
+    Each distinct string is evaluated once, and evaluations run concurrently: the candidates themselves
+    run in the worker pool, so they spread across cores. Only the distinct strings count towards
+    utility.budget; those past the remaining budget score 0 without being run.
+    If the utility has a target, candidates are screened first (see screen_candidates): rejected ones score 0,
+    and duplicates, within the call or of a candidate evaluated earlier in the run, share its score, without using the budget.
+
+    Args:
+        utility (callable): The utility function.
+        algorithm_strs (list of str): The algorithms to score.
+        mode (str): The mode passed to the utility.
+        max_parallel (int): The maximum number of concurrent evaluations, by default the worker pool size.
+
+    Returns:
+        scores (list): The scores of the algorithms, in input order.
+    """
+    representatives = screen_candidates(utility, algorithm_strs)
+    scores = {None: 0, **known_scores(utility, representatives.values(), mode)}
+    unique_strs = [algorithm_str for algorithm_str in dict.fromkeys(representatives.values()) if algorithm_str not in scores]
+    # The uses are taken before evaluating, so that concurrent batches on the same utility can't overspend its budget
+    n_reserved = reserve_uses(utility, len(unique_strs))
+    evaluated_strs = unique_strs[:n_reserved]
+    scores.update({algorithm_str: 0 for algorithm_str in unique_strs})
+
+    def evaluate(algorithm_str):
+        with reserved_use(utility):
+            return utility(algorithm_str, mode=mode)
+
+    evaluated_scores = []
+    try:
+        if evaluated_strs:
+            n_threads = min(max_parallel or worker_pool.n_workers, len(evaluated_strs))
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                evaluated_scores = list(zip(evaluated_strs, executor.map(evaluate, evaluated_strs)))
+            scores.update(evaluated_scores)
+            add_known_scores(utility, evaluated_scores, mode)
+    finally:
+        refund_uses(utility, n_reserved - len(evaluated_scores))
+    return [scores[representatives[algorithm_str]] for algorithm_str in algorithm_strs]
+
+def chunk_bounds(n_instances, n_chunks):
+    """Returns the instance indices splitting n_instances instances into n_chunks chunks (fewer if there are fewer instances)."""
+    return [int(bound) for bound in np.linspace(0, n_instances, min(n_chunks, n_instances) + 1)]
+
+def race_evaluate(utility, algorithm_strs, mode="val", n_chunks=8, z=2.0, min_chunks=2, max_parallel=None):
+    """
+    Scores several algorithms like batch_evaluate, but races them on growing prefixes of the task's instances,
+    so that hopeless or crashing candidates are dropped after a few instances instead of running on all of them.
+    Each round, the remaining candidates are scored on the next of n_chunks equal chunks of instances, concurrently;
+    then, after min_chunks rounds, candidates whose mean chunk score plus z standard errors falls below the best
+    mean minus z standard errors are dropped. The variance of chunk scores is pooled over all candidates.
+    Once one candidate is left, it is scored on the rest of the instances at once.
+
+    The utility must take instance_range and have n_instances (by mode); otherwise every candidate is scored in full,
+    as with batch_evaluate. Each distinct candidate counts as one use of utility.budget, however many chunks it ran on,
+    and candidates are screened and deduplicated first as in batch_evaluate.
+    algorithm_strs can also be an iterable or async iterable, like LanguageModel.stream_prompt, whose candidates
+    are scored as they arrive (see race_stream); then the candidates are returned along with the results.
+
+    Args:
+        utility (callable): The utility function.
+        algorithm_strs (list of str): The algorithms to score.
+        mode (str): The mode passed to the utility.
+        n_chunks (int): The number of chunks the instances are split into.
+        z (float): The width of the confidence bounds, in standard errors.
+        min_chunks (int): The number of chunks every candidate is scored on before any is dropped.
+        max_parallel (int): The maximum number of concurrent evaluations, by default the worker pool size.
+
+    Returns:
+        results (list of (float, bool)): For each algorithm, in input order, its mean score on the instances it ran on,
+        and whether it ran on all of them. A complete score is the instance-weighted mean of the chunk scores,
+        which equals utility's for tasks averaging over instances, unless a chunk failed outright.
+    """
+    if not isinstance(algorithm_strs, (list, tuple)):
+        return race_stream(utility, algorithm_strs, mode, n_chunks, z, min_chunks, max_parallel)
+    if not hasattr(utility, "n_instances"):
+        return [(score, True) for score in batch_evaluate(utility, algorithm_strs, mode, max_parallel)]
+    representatives = screen_candidates(utility, algorithm_strs)
+    known = known_scores(utility, representatives.values(), mode)
+    unique_strs = [
+        algorithm_str for algorithm_str in dict.fromkeys(representatives.values())
+        if algorithm_str is not None and algorithm_str not in known
+    ]
+    # One use per candidate, taken before the race as in batch_evaluate, however many chunks it runs on
+    n_reserved = reserve_uses(utility, len(unique_strs))
+    chunk_scores = {algorithm_str: [] for algorithm_str in unique_strs[:n_reserved]}
+    return run_race(utility, algorithm_strs, representatives, chunk_scores, mode, n_chunks, z, min_chunks, max_parallel)
+
+def run_race(utility, algorithm_strs, representatives, chunk_scores, mode, n_chunks, z, min_chunks, max_parallel):
+    """
+    Races the candidates of chunk_scores, whose uses are already reserved and which were all scored on the same
+    first chunks (or none), and returns the results of algorithm_strs as race_evaluate does.
+    representatives maps each algorithm to the candidate scored in its place (see screen_candidates).
+    """
+    # Candidates already evaluated this run keep their complete score, and don't race
+    results = {representative: (0, False) for representative in representatives.values()}
+    results.update({
+        algorithm_str: (score, True) for algorithm_str, score in known_scores(utility, representatives.values(), mode).items()
+    })
+    n_instances = utility.n_instances[mode]
+    bounds = chunk_bounds(n_instances, n_chunks)
+    remaining = list(chunk_scores)
+
+    def evaluate_chunk(algorithm_str, start, stop):
+        with reserved_use(utility):
+            return utility(algorithm_str, mode=mode, instance_range=(start, stop))
+
+    def rank(remaining, stop):
+        """Records the results of the remaining candidates, scored up to instance stop, and returns those not dropped."""
+        means = {
+            algorithm_str: sum(score * size for score, size in chunk_scores[algorithm_str]) / stop
+            for algorithm_str in remaining
+        }
+        for algorithm_str in remaining:
+            results[algorithm_str] = (means[algorithm_str], stop == n_instances)
+        n_scored_chunks = len(chunk_scores[remaining[0]])
+        if len(remaining) < 2 or n_scored_chunks < min_chunks:
+            return remaining
+        squared_deviations, degrees_of_freedom = 0.0, 0
+        for scores in chunk_scores.values():
+            chunk_mean = np.mean([score for score, _ in scores])
+            squared_deviations += sum((score - chunk_mean) ** 2 for score, _ in scores)
+            degrees_of_freedom += len(scores) - 1
+        standard_error = np.sqrt(squared_deviations / max(degrees_of_freedom, 1) / n_scored_chunks)
+        best_lower_bound = max(means.values()) - z * standard_error
+        return [
+            algorithm_str for algorithm_str in remaining
+            if means[algorithm_str] + z * standard_error >= best_lower_bound
+        ]
+
+    try:
+        # Candidates scored on their first chunks as they arrived (see race_stream) are ranked on those first
+        chunk_idx = len(chunk_scores[remaining[0]]) if remaining else 0
+        if chunk_idx > 0:
+            remaining = rank(remaining, bounds[chunk_idx])
+        n_threads = min(max_parallel or worker_pool.n_workers, max(len(remaining), 1))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            while remaining and chunk_idx < len(bounds) - 1:
+                start = bounds[chunk_idx]
+                # A lone candidate has nothing to race against
+                stop = bounds[chunk_idx + 1] if len(remaining) > 1 else n_instances
+                chunk_idx = bounds.index(stop)
+                scores = executor.map(lambda algorithm_str: evaluate_chunk(algorithm_str, start, stop), remaining)
+                for algorithm_str, score in zip(remaining, scores):
+                    chunk_scores[algorithm_str].append((score, stop - start))
+                remaining = rank(remaining, stop)
+    finally:
+        # The uses of candidates that never got to run go back to the budget
+        refund_uses(utility, sum(not scores for scores in chunk_scores.values()))
+    add_known_scores(utility, [
+        (algorithm_str, score) for algorithm_str, (score, complete) in results.items()
+        if complete and algorithm_str in chunk_scores
+    ], mode)
+    return [results[representatives[algorithm_str]] for algorithm_str in algorithm_strs]
+
+def race_stream(utility, source, mode="val", n_chunks=8, z=2.0, min_chunks=2, max_parallel=None):
+    """
+    race_evaluate for candidates arriving from source, an iterable or async iterable like LanguageModel.stream_prompt,
+    overlapping their generation with their evaluation. source runs through a Pipeline: a "screen" stage screens
+    each candidate as it arrives, and an "evaluate" stage scores each new one on the first min_chunks chunks,
+    which every candidate runs on before any is dropped (or on all instances, if the utility has no n_instances).
+    Once source is exhausted, the race goes on from there as in race_evaluate.
+
+    Returns:
+        algorithm_strs (list of str): The candidates of source, in the order they arrived.
+        results (list of (float, bool)): Their results, as race_evaluate returns them.
+    """
+    partial = hasattr(utility, "n_instances")
+    head_bounds = chunk_bounds(utility.n_instances[mode], n_chunks)[:min_chunks + 1] if partial else None
+    algorithm_strs = []
+    representatives = {}
+    passed_on = set()
+    head_starts = {}
+
+    def screen(algorithm_str):
+        # This stage has one worker, so candidates are recorded in the order they arrived and each is passed on once
+        algorithm_strs.append(algorithm_str)
+        if algorithm_str not in representatives:
+            representatives.update(screen_candidates(utility, [algorithm_str]))
+        representative = representatives[algorithm_str]
+        if representative is None or representative in passed_on or known_scores(utility, [representative], mode):
+            return []
+        passed_on.add(representative)
+        return [representative]
+
+    def evaluate(algorithm_str):
+        if not reserve_uses(utility, 1):
+            return []
+        try:
+            with reserved_use(utility):
+                if partial:
+                    head_starts[algorithm_str] = [
+                        (utility(algorithm_str, mode=mode, instance_range=(start, stop)), stop - start)
+                        for start, stop in zip(head_bounds, head_bounds[1:])
+                    ]
+                else:
+                    head_starts[algorithm_str] = utility(algorithm_str, mode=mode)
+        except Exception:
+            refund_uses(utility, 1)
+            raise
+        return []
+
+    pipeline = Pipeline([
+        PipelineStage("screen", screen, fan_out=True),
+        PipelineStage("evaluate", evaluate, n_workers=max_parallel or worker_pool.n_workers, fan_out=True),
+    ])
+    pipeline.run(source)
+    if not partial:
+        add_known_scores(utility, head_starts.items(), mode)
+        scores = {**known_scores(utility, representatives.values(), mode), **head_starts}
+        return algorithm_strs, [(scores.get(representatives[algorithm_str], 0), True) for algorithm_str in algorithm_strs]
+    results = run_race(utility, algorithm_strs, representatives, head_starts, mode, n_chunks, z, min_chunks, max_parallel)
+    return algorithm_strs, results
+
+class PipelineStage:
+    def __init__(self, name, fn, n_workers=1, fan_out=False):
+        """
+        One stage of a Pipeline.
+
+        Args:
+            name (str): The name of the stage, used in the statistics.
+            fn (callable): Called with each item from the previous stage.
+            n_workers (int): The number of threads calling fn concurrently.
+            fan_out (bool): Whether fn returns a list of items to pass on, rather than one item.
+        """
+        self.name = name
+        self.fn = fn
+        self.n_workers = n_workers
+        self.fan_out = fan_out
+        self.lock = threading.Lock()
+        self.n_in = 0
+        self.n_out = 0
+        self.n_errors = 0
+        self.busy_time = 0.0
+        self.n_workers_done = 0
+
+class Pipeline:
+    def __init__(self, stages, queue_size=4):
+        """
+        Runs items through a sequence of stages concurrently, e.g. generate -> extract -> evaluate,
+        so that network-bound and CPU-bound stages overlap instead of running one after the other.
+        Stages are connected by bounded queues, so a fast stage can't run far ahead of a slow one.
+        Stages run in threads; candidates evaluated by a task utility run in the worker pool,
+        so an evaluation stage with several workers uses several cores.
+
+        Args:
+            stages (list of PipelineStage): The stages, in order.
+            queue_size (int): The maximum number of items waiting for each stage.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.n_source_items = 0
+        self.elapsed = 0.0
+
+    def run_stage(self, stage, input_queue, output_queue, done, n_next_workers):
+        while True:
+            item = input_queue.get()
+            if item is done:
+                break
+            with stage.lock:
+                stage.n_in += 1
+            start_time = time.perf_counter()
+            try:
+                outputs = stage.fn(item)
+                outputs = outputs if stage.fan_out else [outputs]
+            except Exception as e:
+                print(f"Exception in pipeline stage {stage.name}:", e)
+                outputs = []
+                with stage.lock:
+                    stage.n_errors += 1
+            with stage.lock:
+                stage.busy_time += time.perf_counter() - start_time
+            for output in outputs:
+                output_queue.put(output)
+                with stage.lock:
+                    stage.n_out += 1
+        with stage.lock:
+            stage.n_workers_done += 1
+            last_worker = stage.n_workers_done == stage.n_workers
+        if last_worker:
+            for _ in range(n_next_workers):
+                output_queue.put(done)
+
+    def run(self, source):
+        """
+        Feeds the items of source through the stages.
+        source can be an iterable or an async iterable, such as LanguageModel.stream_prompt,
+        which is consumed on an event loop in this thread while the stages run.
+
+        Returns:
+            results (list): The outputs of the last stage, in the order they finished.
+        """
+        start_time = time.perf_counter()
+        done = object()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = queue.Queue()
+        threads = []
+        for stage_idx, stage in enumerate(self.stages):
+            stage.n_workers_done = 0
+            is_last = stage_idx == len(self.stages) - 1
+            output_queue = results if is_last else queues[stage_idx + 1]
+            n_next_workers = 1 if is_last else self.stages[stage_idx + 1].n_workers
+            for _ in range(stage.n_workers):
+                thread = threading.Thread(
+                    target=self.run_stage, args=(stage, queues[stage_idx], output_queue, done, n_next_workers), daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        first_queue = queues[0]
+        try:
+            if hasattr(source, "__aiter__"):
+                async def feed():
+                    loop = asyncio.get_running_loop()
+                    async for item in source:
+                        self.n_source_items += 1
+                        # Waiting for room in the queue must not block the loop the source runs on
+                        await loop.run_in_executor(None, first_queue.put, item)
+                asyncio.run(feed())
+            else:
+                for item in source:
+                    self.n_source_items += 1
+                    first_queue.put(item)
+        finally:
+            for _ in range(self.stages[0].n_workers):
+                first_queue.put(done)
+            for thread in threads:
+                thread.join()
+            self.elapsed += time.perf_counter() - start_time
+        return list(iter(results.get_nowait, done))
+
+    def stats(self):
+        """
+        Returns the counters of each stage: items in and out, errors, busy time (summed over workers)
+        and throughput, in items out per second of pipeline run time.
+        """
+        elapsed = max(self.elapsed, 1e-9)
+        stats = {"source": {"n_out": self.n_source_items, "throughput": self.n_source_items / elapsed}}
+        for stage in self.stages:
+            stats[stage.name] = {
+                "n_in": stage.n_in, "n_out": stage.n_out, "n_errors": stage.n_errors,
+                "busy_time": stage.busy_time, "throughput": stage.n_out / elapsed,
+            }
+        return stats
+
 def read_file_as_str(path):
     with open(path, "r") as f:
         return f.read()
@@ -222,7 +1021,7 @@ You will be evaluated based on the following utility function:
 """
     language_model = LanguageModel(budget=1)
     algorithm_str = language_model.prompt(role, message, n_responses=1, temperature=t)[0]
-    algorithm_str = extract_code(algorithm_str)
+    algorithm_str = extract_code(algorithm_str, policy="defines", base_name="algorithm")
     return algorithm_str
 
 def generate_run_id(iterative, use_seed_algorithm, use_improver, SUBTASK):
@@ -266,6 +1065,22 @@ def end_pool_if_used(pool, join_pools=False):
         if join_pools:
             pool.join()
 
+def save_test_algorithms(run_id, test_idx, name, base_algorithm_str, improved_algorithm_str, metadata=None):
+    """
+    Stores the base and improved algorithms of a meta-utility test in blob_store, indexed under the run.
+    The base algorithm is the same for every test, so it is only written once.
+    """
+    try:
+        iteration = registry.context.get("iteration")
+        base_hash = blob_store.record("base_algorithm", base_algorithm_str, run_id=run_id, iteration=iteration, test_idx=test_idx, name=name)
+        blob_store.record(
+            "improved_algorithm", improved_algorithm_str, parent=base_hash, run_id=run_id, iteration=iteration,
+            test_idx=test_idx, name=name, metadata=metadata
+        )
+    except Exception as e:
+        print("Failed to save algorithms with exception", e)
+        print(traceback.format_exc())
+
 def write_log(expected_utility_val, expected_utility_test, run_id):
     """
     Writes the expected utility to a log file.
@@ -0,0 +1,195 @@
+import os
+import mmap
+import json
+import random
+import hashlib
+import numpy as np
+from config import config
+
+BANK_FORMAT_VERSION = 1
+
+instance_banks = {}
+# The buffers map_npy has mapped, by id, with their paths and addresses (see mapped_array_ref)
+mapped_buffers = {}
+
+def get_instances(task, params, generate_instances):
+    """
+    Returns the benchmark instances of a task, generating them at most once per bank directory.
+
+    Instances are dicts of NumPy arrays. Each field is saved as one flat .npy file holding the values
+    of all instances, plus their shapes, and loaded memory-mapped, so instances are read-only views
+    into the page cache rather than copies. Utilities are re-defined by temp_override on every
+    meta-utility test, so loaded banks are also kept here per process.
+
+    Args:
+        task (str): The name of the task.
+        params (dict): Every parameter the instances depend on (seeds, sizes, generator version, ...).
+            Changing any of them selects a different bank.
+        generate_instances (callable): Generates the list of instances from scratch.
+
+    Returns:
+        instances (list of dict): The instances. Their arrays are read-only: pass them to algorithms through
+        worker_pool, which maps them copy-on-write in the worker (see mapped_array_ref), or pass copies.
+    """
+    params = dict(params, bank_format_version=BANK_FORMAT_VERSION)
+    bank_name = f"{task}_{hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]}"
+    if bank_name not in instance_banks:
+        bank_dir = config['instance_bank_dir']
+        instances = load_bank(bank_dir, bank_name)
+        if instances is None:
+            instances = save_bank(bank_dir, bank_name, params, generate_instances())
+        instance_banks[bank_name] = instances
+    return instance_banks[bank_name]
+
+def select_instances(instances, instance_range=None):
+    """
+    Returns the index of the first selected instance and the instances in instance_range, a (start, stop) pair,
+    or all of them if it is None, so that utilities can score part of their instances (see helpers.race_evaluate).
+    """
+    if instance_range is None:
+        return 0, instances
+    start, stop = instance_range
+    return start, instances[start:stop]
+
+def load_bank(bank_dir, bank_name):
+    index_path = os.path.join(bank_dir, f"{bank_name}.json")
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        return read_fields(os.path.join(bank_dir, index["directory"]), index["n_instances"], index["fields"])
+    except Exception as e:
+        print("Failed to load instance bank", bank_name, "with exception", e)
+        return None
+
+def map_npy(path):
+    """
+    Maps a .npy file read-only, without copying it.
+    np.load's mmap_mode resolves the absolute path with os.getcwd, which reliability_guard disables.
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mapped_buffers[id(buffer)] = (buffer, path, np.frombuffer(buffer, dtype=np.uint8).ctypes.data)
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+class MappedArrayRef:
+    def __init__(self, path, offset, shape, dtype, strides):
+        """A reference to the data of an array in a mapped .npy file, which unpickles as the array (see map_array_copy)."""
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.strides = strides
+
+    def __reduce__(self):
+        return map_array_copy, (self.path, self.offset, self.shape, self.dtype, self.strides)
+
+def mapped_array_ref(array):
+    """
+    Returns a MappedArrayRef to array if it is a view into a file mapped by map_npy, like the arrays of instances,
+    so that worker processes can map the same pages instead of receiving a copy, or None otherwise.
+    """
+    if not isinstance(array, np.ndarray):
+        return None
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if isinstance(base, memoryview):
+        base = base.obj
+    mapped = mapped_buffers.get(id(base))
+    if mapped is None or mapped[0] is not base:
+        return None
+    _, path, address = mapped
+    return MappedArrayRef(path, array.__array_interface__["data"][0] - address, array.shape, array.dtype, array.strides)
+
+def map_array_copy(path, offset, shape, dtype, strides):
+    """
+    Maps the array a MappedArrayRef refers to copy-on-write: it shares the file's pages until it is written to,
+    and writes stay private to the process, so algorithms can modify their inputs without touching the bank.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset, strides=strides)
+
+def read_fields(directory, n_instances, fields):
+    instances = [{} for _ in range(n_instances)]
+    for field in fields:
+        values = map_npy(os.path.join(directory, f"{field}.npy"))
+        shapes = np.load(os.path.join(directory, f"{field}.shapes.npy"))
+        offset = 0
+        for instance, shape in zip(instances, shapes):
+            size = int(np.prod(shape))
+            instance[field] = values[offset:offset + size].reshape(tuple(shape))
+            offset += size
+    return instances
+
+def save_bank(bank_dir, bank_name, params, instances):
+    """
+    Saves the instances and returns them memory-mapped from disk.
+    Files can't be renamed once reliability_guard has run, so each process writes its own directory
+    and the index file, created exclusively, decides which one is used.
+    """
+    directory = f"{bank_name}_{os.getpid()}"
+    os.makedirs(os.path.join(bank_dir, directory), exist_ok=True)
+    fields = list(instances[0].keys()) if instances else []
+    for field in fields:
+        values = [np.asarray(instance[field]) for instance in instances]
+        shapes = np.array([value.shape for value in values], dtype=np.int64).reshape(len(values), -1)
+        flat_values = np.concatenate([value.reshape(-1) for value in values])
+        np.save(os.path.join(bank_dir, directory, f"{field}.npy"), flat_values)
+        np.save(os.path.join(bank_dir, directory, f"{field}.shapes.npy"), shapes)
+    index = {"params": params, "directory": directory, "n_instances": len(instances), "fields": fields}
+    try:
+        with open(os.path.join(bank_dir, f"{bank_name}.json"), "x") as f:
+            json.dump(index, f)
+    except FileExistsError:
+        # Another process saved the same bank first; ours is just as valid
+        pass
+    return read_fields(os.path.join(bank_dir, directory), len(instances), fields)
+
+def capture_random_states(python=True, numpy=True):
+    """
+    Returns the states of random and/or np.random as arrays to store with an instance, so that algorithms
+    can see the same randomness as when the instance was generated right before calling them.
+    """
+    random_states = {}
+    if python:
+        random_states["random_state"] = np.array(random.getstate()[1], dtype=np.uint32)
+    if numpy:
+        _, np_key, np_pos, np_has_gauss, np_cached_gaussian = np.random.get_state()
+        random_states["np_random_state"] = np.append(np_key, np_pos).astype(np.uint32)
+        random_states["np_random_gauss"] = np.array([np_has_gauss, np_cached_gaussian], dtype=np.float64)
+    return random_states
+
+def get_random_states(instance, np_seed=None):
+    """
+    Returns the random and np.random states that restore_random_states would leave, without changing them,
+    so that concurrent evaluations can each pass their own states to the worker pool.
+    np.random is seeded with np_seed if the instance has no state for it; otherwise, states missing
+    from the instance are the current ones.
+    """
+    random_state = random.getstate()
+    if "random_state" in instance:
+        random_state = (3, tuple(int(x) for x in instance["random_state"]), None)
+    if "np_random_state" in instance:
+        np_state = instance["np_random_state"]
+        has_gauss, cached_gaussian = instance["np_random_gauss"]
+        np_random_state = ("MT19937", np.array(np_state[:-1]), int(np_state[-1]), int(has_gauss), float(cached_gaussian))
+    elif np_seed is not None:
+        np_random_state = np.random.RandomState(np_seed).get_state()
+    else:
+        np_random_state = np.random.get_state()
+    return random_state, np_random_state
+
+def restore_random_states(instance):
+    """Restores the random and np.random states stored with an instance, if any."""
+    random_state, np_random_state = get_random_states(instance)
+    random.setstate(random_state)
+    np.random.set_state(np_random_state)
@@ -1,34 +1,25 @@
 from collections import defaultdict
-import openai
 import time
-import random
+import asyncio
+import threading
 import os
 import traceback
-import jsonlines
 import hashlib
 from config import config    
-try:
-    from api_key import openai_key
-except:
-    raise Exception("Create an api_key.py file with a dict including your OpenAI API key.")
+from response_cache import response_cache
+from rate_limiter import TokenBucket
+from usage_log import usage_log
+from telemetry import registry
+from blob_store import blob_store
+from lm_backend import create_backend, completion_tokens_total
 from concurrent.futures import ThreadPoolExecutor as ThreadPool
 from collections import Counter
 
 MAX_BATCH = 5  # most number to query at once
 MAX_TOKENS = 1024
 
-def set_openai_key():
-    """Sets OpenAI key."""
-    if 'api_type' in openai_key and openai_key['api_type'] == 'azure':
-        openai.api_type = "azure"
-        openai.api_version = "2023-03-15-preview"
-        openai.api_base = openai_key['api_base']
-    else:
-        if 'organization' in openai_key:
-            openai.organization = openai_key['organization']
-    openai.api_key = openai_key['api_key']
-
-if openai.api_type == 'azure':
+backend = create_backend(config['language_model_backend'])
+if backend.api_type == 'azure':
     # These will depend on how you deployed the OpenAI resource on Azure
     CHAT_GPT_35 = "gpt-35-turbo"
     CHAT_GPT_4 = "gpt-4"
@@ -38,36 +29,66 @@ else:
 default_engine = CHAT_GPT_4
 
 cache_counter = defaultdict(int)
-set_openai_key()
-
-def write_to_usage_log(role, message, n, t):
-    # Write to usage log - using jsonlines for easy appending
-    try:
-        with jsonlines.open("usage_log.jsonl", "a") as writer:
-            writer.write([
-                time.time(),
-                {
-                    "role": role,
-                    "message": message,
-                    "n": n,
-                    "t": t,
-                }
-            ])
-    except Exception as e:
-        print("Failed to write to usage log with exception", e)
-        print("Traceback:", traceback.format_exc())
+rate_limiter = TokenBucket(
+    config['language_model_requests_per_second'],
+    config['language_model_tokens_per_minute'],
+    min_requests_per_second=15 / 60,
+)
+calls_total = registry.counter("language_model_calls_total", "Prompt calls, including the ones answered from the cache")
+cache_hits_total = registry.counter("language_model_cache_hits_total", "Prompt calls answered from the cache")
+queue_wait_seconds = registry.histogram("language_model_queue_wait_seconds", "Seconds requests waited on the rate limiter")
+retries_total = registry.counter("language_model_retries_total", "Requests retried after an error other than a rate limit")
+rate_limited_total = registry.counter("language_model_rate_limited_total", "Requests rejected by a rate limit (429)")
+rate_limit_gauge = registry.gauge("language_model_rate_limit", "Requests per second currently allowed by the rate limiter")
+
+def write_to_usage_log(role, message, n, t, latency=0.0, responses=(), cached=False):
+    # Queued for the background writer of usage_log, which stores the role and message once by hash
+    usage_log.log(
+        role, message, n=n, t=t, latency=latency, cached=cached, **registry.context,
+        prompt_tokens=(len(role) + len(message)) // 4,
+        completion_tokens=sum(len(response) for response in responses) // 4,
+    )
+
+def is_rate_limit_error(e):
+    return "https://aka.ms/oai/quotaincrease" in str(e) or "Rate limit reached for" in str(e)
+
+def estimate_tokens(messages, n):
+    """Upper estimate of the tokens a request counts against the quota: the prompt plus n completions."""
+    return sum(len(message["content"]) for message in messages) // 4 + n * MAX_TOKENS
+
+class SharedBudget:
+    def __init__(self, total=None):
+        """
+        A budget of uses shared by several callers, e.g. the concurrent lineages of a population.
+
+        Args:
+            total (int): The number of uses, or None for no limit.
+        """
+        self.lock = threading.Lock()
+        self.total = total
+        self.used = 0
+
+    def take(self, n=1):
+        """Uses n of the budget, if there is enough left. Returns whether there was."""
+        with self.lock:
+            if self.total is not None and self.used + n > self.total:
+                return False
+            self.used += n
+            return True
 
 class LanguageModel:
-    def __init__(self, budget):
+    def __init__(self, budget, shared_budget=None, cache_counter=cache_counter):
         """
         Initializes the language model.
 
         Args:
             role (str): The role of the language model.
+            shared_budget (SharedBudget): A budget that calls also count against, if any.
+            cache_counter (defaultdict): How many times each call was replayed or stored, which picks the cached
+                responses to replay. By default the module's cache_counter, shared by all language models
+                and cleared in place by run_improver.
         """
-        self.next_request_time = time.time()
-        self.rate_limit = 0.5  # Initial requests per second - will automatically lower if not feasible
-        self.min_rate_limit = 15 / 60  # Can't be lower than this
+        self.rate_limiter = rate_limiter  # Shared across calls and instances, so backoff carries over
         self.global_timeout = 1024
         if not os.path.exists("cache"):
             os.mkdir("cache")
@@ -75,74 +96,52 @@ class LanguageModel:
         self.use_cache = config['use_language_model_cache']
         self.times_used = 0
         self.budget = budget
+        self.shared_budget = shared_budget
         self.max_responses_per_call = config['max_responses_per_call']
+        self.pending_calls = {}  # Calls waiting on the API, by cache key, logged once they finish
 
-    def prompt(self, expertise, message, n_responses=1, temperature=0.7):
+    def cache_lookup(self, cache_key):
         """
-        Generates a response to a message.
+        Replays the cached responses for the current repetition of a call, if there are any.
 
         Args:
-            expertise (str): The expertise of the language model.
-            message (str): The message to respond to.
-            n (int): The number of responses to generate.
-            t (float): The temperature of the language model.
+            cache_key (str): The hash of the call arguments.
 
         Returns:
-            responses (list of str): The responses generated by the language model.
+            responses (list of str or None): The cached responses, or None on a miss.
         """
-        # Make sure the message is a string
-        role = expertise
-        assert isinstance(message, str)
-        assert isinstance(role, str)
-        assert n_responses <= self.max_responses_per_call
+        if not response_cache.has_entry(cache_key, 0):
+            return None
+        self.cache_counter[cache_key] += 1
+        if response_cache.has_entry(cache_key, self.cache_counter[cache_key]):
+            return response_cache.get(cache_key, self.cache_counter[cache_key] - 1)
+        return None
+
+    def log_finished_call(self, cache_key, results):
+        if cache_key not in self.pending_calls:
+            return
+        role, message, n, t, start_time = self.pending_calls.pop(cache_key)
+        write_to_usage_log(role, message, n, t, latency=time.perf_counter() - start_time, responses=results)
+
+    def cache_store(self, cache_key, results):
+        try:
+            response_cache.append(cache_key, results)
+        except Exception as e:
+            print("Failed to write to cache with exception", e)
+            print("Traceback:", traceback.format_exc())
+        if self.use_cache:
+            self.cache_counter[cache_key] += 1
+
+    def use_call(self):
         self.times_used += 1
         if self.times_used > self.budget:
             raise Exception("Error: You have exceeded your call budget.")
-        n, t = n_responses, temperature
-        cache_key = str((message, n, t))
-        cache_file = f"{hashlib.sha256(cache_key.encode()).hexdigest()}.jsonl"
-        write_to_usage_log(role, message, n, t)
-        if self.use_cache:
-            if cache_file in os.listdir("cache"):
-                self.cache_counter[cache_file] += 1
-                # Open the file as a jsonl file
-                try:
-                    with jsonlines.open(f"cache/{cache_file}") as reader:
-                        messages = [message for message in reader]
-                except Exception as e:
-                    print("Failed to read from cache with exception", e)
-                    print("Traceback:", traceback.format_exc())
-                    messages = []
-                    # Remove the cache file
-                    try:
-                        os.remove(f"cache/{cache_file}")
-                    except Exception as e:
-                        print("Failed to remove cache file with exception", e)
-                        print("Traceback:", traceback.format_exc())
-                if len(messages) > self.cache_counter[cache_file]:
-                    return messages[self.cache_counter[cache_file] - 1]
-        max_n = MAX_BATCH
-        max_tokens = MAX_TOKENS
-        next_request_time = self.next_request_time
-        rate_limit = self.rate_limit
-        global_timeout = self.global_timeout
-        min_rate_limit = self.min_rate_limit
-        engine = default_engine
-        system = role
-        user = [message]
-        n_max_messages = 8
-        temperature = t
+        if self.shared_budget is not None and not self.shared_budget.take():
+            raise Exception("Error: You have exceeded the shared call budget.")
 
-        # Prompt the model
-        remaining = n
-        remaining_to_submit = n
-        error_count = 0
-        while time.time() < next_request_time:
-            time.sleep(random.random() * 0.01)
-
-        # Tell everyone to wait for one rate limit iteration per call
-        next_request_time = time.time() + (n / max_n) / rate_limit
-        messages=[{"role": "system", "content": system}]
+    def build_messages(self, system, user):
+        n_max_messages = 8
+        messages = [{"role": "system", "content": system}]
         for u_id, u in enumerate(user):
             role = "user" if u_id % 2 == 0 else "assistant"
             messages.append({"role": role, "content": u})
@@ -151,77 +150,181 @@ class LanguageModel:
                 raise Exception("Error: This will exclude the system prompt.")
             else:
                 messages = messages[:n_max_messages // 2] + messages[-n_max_messages // 2:]
-        # Select a backend at random
+        return messages
+
+    def completion_kwargs(self, messages, n, temperature, timeout):
+        engine_key = "engine" if backend.api_type == "azure" else "model"
+        return {
+            engine_key: default_engine, "messages": messages, "n": n, "temperature": temperature,
+            "max_tokens": MAX_TOKENS, "timeout": timeout,
+        }
+
+    def query_api(self, messages, n, temperature, timeout):
+        """
+        Sends one chat completion request, waiting on the shared rate limiter and retrying on errors.
+
+        Returns:
+            choices (list): The choices of the response.
+        """
+        error_count = 0
+        while True:
+            wait_start = time.perf_counter()
+            self.rate_limiter.acquire(estimate_tokens(messages, n))
+            queue_wait_seconds.observe(time.perf_counter() - wait_start)
+            try:
+                choices = backend.create(**self.completion_kwargs(messages, n, temperature, timeout))
+                self.rate_limiter.on_success()
+                rate_limit_gauge.set(self.rate_limiter.requests_per_second)
+                return choices
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    print("Error while querying OpenAI API. Retrying...", e)
+                    error_count += 1
+                    if error_count > 10:
+                        raise e
+                    retries_total.inc()
+                else:
+                    self.rate_limiter.on_rate_limited()
+                    rate_limited_total.inc()
+                    rate_limit_gauge.set(self.rate_limiter.requests_per_second)
+
+    async def query_api_async(self, messages, n, temperature, timeout):
+        """Asynchronous version of query_api."""
+        error_count = 0
+        while True:
+            wait_start = time.perf_counter()
+            await self.rate_limiter.acquire_async(estimate_tokens(messages, n))
+            queue_wait_seconds.observe(time.perf_counter() - wait_start)
+            try:
+                choices = await backend.acreate(**self.completion_kwargs(messages, n, temperature, timeout))
+                self.rate_limiter.on_success()
+                rate_limit_gauge.set(self.rate_limiter.requests_per_second)
+                return choices
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    print("Error while querying OpenAI API. Retrying...", e)
+                    error_count += 1
+                    if error_count > 10:
+                        raise e
+                    retries_total.inc()
+                else:
+                    self.rate_limiter.on_rate_limited()
+                    rate_limited_total.inc()
+                    rate_limit_gauge.set(self.rate_limiter.requests_per_second)
+
+    def prepare_prompt(self, expertise, message, n_responses, temperature):
+        """Checks the arguments and budget of prompt. Returns the cache key and the cached responses, if any."""
+        # Make sure the message is a string
+        role = expertise
+        assert isinstance(message, str)
+        assert isinstance(role, str)
+        assert n_responses <= self.max_responses_per_call
+        self.use_call()
+        n, t = n_responses, temperature
+        cache_key = hashlib.sha256(str((message, n, t)).encode()).hexdigest()
+        cached = self.cache_lookup(cache_key) if self.use_cache else None
+        calls_total.inc()
+        if cached is not None:
+            cache_hits_total.inc()
+            write_to_usage_log(role, message, n, t, responses=cached, cached=True)
+        else:
+            self.pending_calls[cache_key] = (role, message, n, t, time.perf_counter())
+        return cache_key, cached
+
+    def prepare_batch_prompt(self, expertise, message_batch, temperature):
+        """Checks the arguments and budget of batch_prompt. Returns the cache key and the cached responses, if any."""
+        # Make sure the message is a string
+        role = expertise
+        assert len(message_batch) <= self.max_responses_per_call
+        assert isinstance(message_batch[0], str)
+        assert isinstance(role, str)
+        self.use_call()
+        n, t = 1, temperature
+        cache_key = hashlib.sha256(str((str(message_batch), n, t)).encode()).hexdigest()
+        cached = self.cache_lookup(cache_key) if self.use_cache else None
+        calls_total.inc()
+        if cached is not None:
+            cache_hits_total.inc()
+            write_to_usage_log(role, str(message_batch), n, t, responses=cached, cached=True)
+        else:
+            self.pending_calls[cache_key] = (role, str(message_batch), n, t, time.perf_counter())
+        return cache_key, cached
+
+    def finish_prompt(self, cache_key, message, result, n):
+        # Convert the response to a list of strings (or one string if n=1)
+        results = [choice.message.content for choice in result]
+        return self.save_responses(cache_key, message, results, n)
+
+    def save_generation(self, message, responses):
+        """Stores an improve_algorithm prompt and its responses in blob_store, attributed to the current run."""
+        try:
+            context = {name: registry.context.get(name) for name in ("run_id", "iteration", "test_idx")}
+            prompt_hash = blob_store.record("prompt", message, **context)
+            for res_idx, response in enumerate(responses):
+                blob_store.record("response", response, parent=prompt_hash, name=str(res_idx), **context)
+        except Exception as e:
+            print("Failed to save generation with exception", e)
+            print("Traceback:", traceback.format_exc())
+
+    def save_responses(self, cache_key, message, results, n):
+        if len(results) == n and "improve_algorithm" in message:
+            self.save_generation(message, results)
+        self.log_finished_call(cache_key, results)
+        self.cache_store(cache_key, results)
+        return results
+
+    def finish_batch_prompt(self, cache_key, message_batch, result):
+        # Convert the response to a list of strings (or one string if n=1)
+        results = [choice.message.content for choice in result]
+        responses_by_message = defaultdict(list)
+        for message, response in zip(message_batch, results):
+            if "improve_algorithm" in message:
+                responses_by_message[message].append(response)
+        for message, responses in responses_by_message.items():
+            self.save_generation(message, responses)
+        self.log_finished_call(cache_key, results)
+        self.cache_store(cache_key, results)
+        return results
+
+    def prompt(self, expertise, message, n_responses=1, temperature=0.7):
+        """
+        Generates a response to a message.
+
+        Args:
+            expertise (str): The expertise of the language model.
+            message (str): The message to respond to.
+            n (int): The number of responses to generate.
+            t (float): The temperature of the language model.
+
+        Returns:
+            responses (list of str): The responses generated by the language model.
+        """
+        cache_key, cached = self.prepare_prompt(expertise, message, n_responses, temperature)
+        if cached is not None:
+            return cached
+        n = n_responses
+        messages = self.build_messages(expertise, [message])
         result = []
-        print(f"Querying OpenAI API with messages... {remaining} left")
-
-        def query_api(cur_n):
-            set_openai_key()
-            if openai.api_type == "azure":
-                result.extend(openai.ChatCompletion.create(
-                    engine=engine, messages=messages, n=cur_n, temperature=temperature,
-                    max_tokens=max_tokens, timeout=global_timeout * cur_n
-                ).choices)
-            else:
-                result.extend(openai.ChatCompletion.create(
-                    model=engine, messages=messages, n=cur_n, temperature=temperature,
-                    max_tokens=max_tokens, timeout=global_timeout * cur_n
-                ).choices)
+        print(f"Querying OpenAI API with messages... {n} left")
 
         threadpool = ThreadPool(max_workers=16)
         threadpool_futures = []
-        # Submit the requests in parallel
+        # Submit the requests in parallel - the rate limiter spaces them out
+        remaining_to_submit = n
         while remaining_to_submit > 0:
-            cur_n = min(max_n, remaining_to_submit)
-            threadpool_futures.append((cur_n, threadpool.submit(query_api, cur_n)))
+            cur_n = min(MAX_BATCH, remaining_to_submit)
+            threadpool_futures.append((cur_n, threadpool.submit(
+                self.query_api, messages, cur_n, temperature, self.global_timeout * cur_n)))
             remaining_to_submit -= cur_n
-            time.sleep(rate_limit)
 
-        # Wait for the requests to finish. If they fail, retry them.
-        while remaining > 0:
-            if error_count > 10:
-                break
-            new_threadpool_futures = []
-            for future_n, future in threadpool_futures:
-                try:
-                    future.result()
-                    remaining -= future_n
-                    rate_limit *= 1.01
-                    print("Success! Queried OpenAI API with", future_n, "messages.")
-                except Exception as e:
-                    if "https://aka.ms/oai/quotaincrease" not in str(e) and "Rate limit reached for" not in str(e):
-                        print("Error while querying OpenAI API. Retrying...", e)
-                        error_count += 1
-                    else:
-                        rate_limit = max(rate_limit * 0.9, min_rate_limit)
-                    new_threadpool_futures.append((future_n, threadpool.submit(query_api, future_n,)))
-            threadpool_futures = new_threadpool_futures
-
-        if remaining == 0:
-            if "improve_algorithm" in message:
-                write_time = time.time()
-                save_folder = f"creativity/{int(write_time)}"
-                os.makedirs(save_folder, exist_ok=True)
-                with open(f"{save_folder}/message.txt", "w") as writer:
-                    writer.write(message)
-                for res_idx, res in enumerate(result):
-                    with open(f"{save_folder}/response_{res_idx}.txt", "w") as writer:
-                        writer.write(res.message.content)
-        # Convert the response to a list of strings (or one string if n=1)
-        results = [choice.message.content for choice in result]
-        if cache_file not in os.listdir("cache"):
-            with jsonlines.open(f"cache/{cache_file}", "w") as writer:
-                writer.write(results)
-        else:
+        for future_n, future in threadpool_futures:
             try:
-                with jsonlines.open(f"cache/{cache_file}", "a") as writer:
-                    writer.write(results)
+                result.extend(future.result())
+                print("Success! Queried OpenAI API with", future_n, "messages.")
             except Exception as e:
-                print("Failed to write to existing cache with exception", e)
-                print("Traceback:", traceback.format_exc())
-        if self.use_cache:
-            self.cache_counter[cache_file] += 1
-        return results
+                print("Giving up on querying OpenAI API with", future_n, "messages:", e)
+        threadpool.shutdown(wait=False)
+        return self.finish_prompt(cache_key, message, result, n)
 
     def batch_prompt(self, expertise, message_batch, temperature):
         """
@@ -236,137 +339,191 @@ class LanguageModel:
         Returns:
             responses (list of str): The responses generated by the language model.
         """
-        # Make sure the message is a string
-        role = expertise
         try:
             message_batch = list(message_batch)
         except:
             return []
-        assert len(message_batch) <= self.max_responses_per_call
-        assert isinstance(message_batch[0], str)
-        assert isinstance(role, str)
-        self.times_used += 1
-        if self.times_used > self.budget:
-            raise Exception("Error: You have exceeded your call budget.")
-        n, t = 1, temperature
-        cache_key = str((str(message_batch), n, t))
-        cache_file = f"{hashlib.sha256(cache_key.encode()).hexdigest()}.jsonl"
-        write_to_usage_log(role, str(message_batch), n, t)
-        if self.use_cache:
-            if cache_file in os.listdir("cache"):
-                self.cache_counter[cache_file] += 1
-                # Open the file as a jsonl file
-                try:
-                    with jsonlines.open(f"cache/{cache_file}") as reader:
-                        messages = [message for message in reader]
-                except Exception as e:
-                    print("Failed to read from cache with exception", e)
-                    print("Traceback:", traceback.format_exc())
-                    messages = []
-                    # Remove the cache file
-                    try:
-                        os.remove(f"cache/{cache_file}")
-                    except Exception as e:
-                        print("Failed to remove cache file with exception", e)
-                        print("Traceback:", traceback.format_exc())
-                if len(message_batch) > self.cache_counter[cache_file]:
-                    return messages[self.cache_counter[cache_file] - 1]
-        max_n = MAX_BATCH
-        max_tokens = MAX_TOKENS
-        next_request_time = self.next_request_time
-        rate_limit = self.rate_limit
-        global_timeout = self.global_timeout
-        min_rate_limit = self.min_rate_limit
-        engine = default_engine
-        system = role
-        n_max_messages = 8
-        temperature = t
-
-        # Prompt the model
-        error_count = 0
-        while time.time() < next_request_time:
-            time.sleep(random.random() * 0.01)
-
-        # Select a backend at random
+        cache_key, cached = self.prepare_batch_prompt(expertise, message_batch, temperature)
+        if cached is not None:
+            return cached
         result = []
         print(f"Querying OpenAI API with messages... {len(message_batch)} left")
 
-        def query_api(user, n_responses=1):
-            # Tell everyone to wait for one rate limit iteration per call
-            next_request_time = time.time() + (n / max_n) / rate_limit
-            messages=[{"role": "system", "content": system}]
-            for u_id, u in enumerate(user):
-                role = "user" if u_id % 2 == 0 else "assistant"
-                messages.append({"role": role, "content": u})
-            if len(messages) > n_max_messages:
-                if n_max_messages == 1:
-                    raise Exception("Error: This will exclude the system prompt.")
-                else:
-                    messages = messages[:n_max_messages // 2] + messages[-n_max_messages // 2:]
-
-            set_openai_key()
-            if openai.api_type == "azure":
-                result.extend(openai.ChatCompletion.create(
-                    engine=engine, messages=messages, n=n_responses, temperature=temperature,
-                    max_tokens=max_tokens, timeout=global_timeout
-                ).choices)
-            else:
-                result.extend(openai.ChatCompletion.create(
-                    model=engine, messages=messages, n=n_responses, temperature=temperature,
-                    max_tokens=max_tokens, timeout=global_timeout
-                ).choices)
-
         threadpool = ThreadPool(max_workers=16)
         threadpool_futures = []
         # Submit the requests in parallel - group them together to save on time
         message_batch_counts = Counter(message_batch)
         for message, count in message_batch_counts.items():
-            threadpool_futures.append((message, threadpool.submit(query_api, [message], count)))
-            time.sleep(rate_limit)
+            messages = self.build_messages(expertise, [message])
+            threadpool_futures.append(threadpool.submit(
+                self.query_api, messages, count, temperature, self.global_timeout))
 
-        # Wait for the requests to finish. If they fail, retry them.
-        while len(threadpool_futures) > 0:
-            if error_count > 10:
+        for future in threadpool_futures:
+            try:
+                result.extend(future.result())
+                print("Success! Queried OpenAI API")
+            except Exception as e:
+                print("Giving up on querying OpenAI API:", e)
+        threadpool.shutdown(wait=False)
+        return self.finish_batch_prompt(cache_key, message_batch, result)
+
+    async def stream_api_async(self, messages, n, temperature, timeout, should_cancel):
+        """
+        Streams one request for n completions, tracking the code blocks of each as its tokens arrive, and yields
+        each completion as soon as it finishes. A completion that should_cancel says has gone off the rails is
+        dropped right away; since the completions of a request can't be stopped one by one, the request itself
+        is closed once every unfinished completion has been dropped. Errors before the first token are retried
+        like in query_api_async.
+
+        Yields:
+            text (str): A completion.
+            tracker (CodeBlockTracker): The tracker of the completion, fed all of it but not finished.
+            cancelled (bool): Whether the completion was dropped early.
+        """
+        from helpers import CodeBlockTracker
+        error_count = 0
+        while True:
+            wait_start = time.perf_counter()
+            await self.rate_limiter.acquire_async(estimate_tokens(messages, n))
+            queue_wait_seconds.observe(time.perf_counter() - wait_start)
+            try:
+                response = await backend.acreate(**self.completion_kwargs(messages, n, temperature, timeout), stream=True)
+                self.rate_limiter.on_success()
+                rate_limit_gauge.set(self.rate_limiter.requests_per_second)
                 break
-            new_threadpool_futures = []
-            for future_message, future in threadpool_futures:
-                try:
-                    future.result()
-                    rate_limit *= 1.01
-                    print("Success! Queried OpenAI API")
-                except Exception as e:
-                    if "https://aka.ms/oai/quotaincrease" not in str(e) and "Rate limit reached for" not in str(e):
-                        print("Error while querying OpenAI API. Retrying...", e)
-                        error_count += 1
-                    else:
-                        rate_limit = max(rate_limit * 0.9, min_rate_limit)
-                    new_threadpool_futures.append((future_message, threadpool.submit(query_api, [future_message],)))
-            threadpool_futures = new_threadpool_futures
-
-        write_time = time.time()
-        save_folder = f"creativity/{int(write_time)}"
-        for res_idx, (message, cur_result) in enumerate(zip(message_batch, result)):
-            if "improve_algorithm" in message:
-                os.makedirs(save_folder, exist_ok=True)
-                with open(f"{save_folder}/message.txt", "w") as writer:
-                    writer.write(message)
-                with open(f"{save_folder}/response_{res_idx}.txt", "w") as writer:
-                    writer.write(cur_result.message.content)
-        # Convert the response to a list of strings (or one string if n=1)
-        results = [choice.message.content for choice in result]
-        if cache_file not in os.listdir("cache"):
-            with jsonlines.open(f"cache/{cache_file}", "w") as writer:
-                writer.write(results)
-        else:
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    print("Error while querying OpenAI API. Retrying...", e)
+                    error_count += 1
+                    if error_count > 10:
+                        raise e
+                    retries_total.inc()
+                else:
+                    self.rate_limiter.on_rate_limited()
+                    rate_limited_total.inc()
+                    rate_limit_gauge.set(self.rate_limiter.requests_per_second)
+        trackers = [CodeBlockTracker() for _ in range(n)]
+        pieces = [[] for _ in range(n)]
+        unfinished = set(range(n))
+        try:
+            async for chunk in response:
+                for choice in chunk["choices"]:
+                    idx = choice["index"]
+                    if idx not in unfinished:
+                        continue
+                    piece = choice["delta"].get("content") or ""
+                    pieces[idx].append(piece)
+                    trackers[idx].feed(piece)
+                    cancelled = should_cancel(trackers[idx])
+                    if cancelled or choice.get("finish_reason") is not None:
+                        unfinished.discard(idx)
+                        yield "".join(pieces[idx]), trackers[idx], cancelled
+                if not unfinished:
+                    break
+            # Completions the stream ended without a finish_reason
+            for idx in sorted(unfinished):
+                yield "".join(pieces[idx]), trackers[idx], False
+        finally:
+            # Closing the stream early drops the connection, so the rest is never generated
+            await response.aclose()
+            # Streams don't report usage, so the completion is estimated like in estimate_tokens
+            completion_tokens_total.inc(sum(len(piece) for choice_pieces in pieces for piece in choice_pieces) // 4)
+
+    async def stream_prompt(self, expertise, message, n_responses=1, temperature=0.7, should_cancel=None):
+        """
+        Generates responses to a message as an async iterator of the code they contain, yielding each one
+        as soon as its completion finishes, so that callers can score early ones while the rest generate.
+        All the responses come from one streamed n= request (see stream_api_async), so the prompt is sent once.
+        Responses that should_cancel stops (by default helpers.is_off_the_rails) or that contain no code are skipped.
+
+        Args:
+            expertise (str): The expertise of the language model.
+            message (str): The message to respond to.
+            n_responses (int): The number of responses to generate.
+            temperature (float): The temperature of the language model.
+            should_cancel (callable): Called with the CodeBlockTracker of a response after each token.
+
+        Yields:
+            code (str): The largest code block of a response, as extract_code returns it.
+        """
+        from helpers import extract_code, is_off_the_rails
+        should_cancel = should_cancel or is_off_the_rails
+        cache_key, cached = self.prepare_prompt(expertise, message, n_responses, temperature)
+        if cached is not None:
+            for response in cached:
+                code = extract_code(response)
+                if code is not None:
+                    yield code
+            return
+        messages = self.build_messages(expertise, [message])
+        print(f"Streaming OpenAI API responses... {n_responses} left")
+        stream = self.stream_api_async(
+            messages, n_responses, temperature, self.global_timeout * n_responses, should_cancel
+        )
+        results = []
+        try:
             try:
-                with jsonlines.open(f"cache/{cache_file}", "a") as writer:
-                    writer.write(results)
+                async for text, tracker, cancelled in stream:
+                    if cancelled:
+                        print("Cancelled a response after", tracker.n_chars, "characters")
+                        continue
+                    results.append(text)
+                    code = tracker.finish()
+                    if code is not None:
+                        yield code
             except Exception as e:
-                print("Failed to write to existing cache with exception", e)
-                print("Traceback:", traceback.format_exc())
-        if self.use_cache:
-            self.cache_counter[cache_file] += 1
-        return results
+                print("Giving up on streaming from OpenAI API:", e)
+            # Only cached once every response is done, so that replays see the same responses
+            self.save_responses(cache_key, message, results, n_responses)
+        finally:
+            await stream.aclose()
+
+class AsyncLanguageModel(LanguageModel):
+    """
+    Asyncio version of LanguageModel: prompt and batch_prompt are coroutines, and requests wait on
+    the process-wide rate limiter instead of a thread pool, so concurrent callers share the quota.
+    """
+    async def prompt(self, expertise, message, n_responses=1, temperature=0.7):
+        cache_key, cached = self.prepare_prompt(expertise, message, n_responses, temperature)
+        if cached is not None:
+            return cached
+        n = n_responses
+        messages = self.build_messages(expertise, [message])
+        print(f"Querying OpenAI API with messages... {n} left")
+        batch_sizes = [min(MAX_BATCH, n - start) for start in range(0, n, MAX_BATCH)]
+        responses = await asyncio.gather(*[
+            self.query_api_async(messages, cur_n, temperature, self.global_timeout * cur_n)
+            for cur_n in batch_sizes
+        ], return_exceptions=True)
+        result = []
+        for cur_n, response in zip(batch_sizes, responses):
+            if isinstance(response, Exception):
+                print("Giving up on querying OpenAI API with", cur_n, "messages:", response)
+            else:
+                result.extend(response)
+        return self.finish_prompt(cache_key, message, result, n)
+
+    async def batch_prompt(self, expertise, message_batch, temperature):
+        try:
+            message_batch = list(message_batch)
+        except:
+            return []
+        cache_key, cached = self.prepare_batch_prompt(expertise, message_batch, temperature)
+        if cached is not None:
+            return cached
+        print(f"Querying OpenAI API with messages... {len(message_batch)} left")
+        message_batch_counts = Counter(message_batch)
+        responses = await asyncio.gather(*[
+            self.query_api_async(self.build_messages(expertise, [message]), count, temperature, self.global_timeout)
+            for message, count in message_batch_counts.items()
+        ], return_exceptions=True)
+        result = []
+        for response in responses:
+            if isinstance(response, Exception):
+                print("Giving up on querying OpenAI API:", response)
+            else:
+                result.extend(response)
+        return self.finish_batch_prompt(cache_key, message_batch, result)
 
 def test_lm():
     global MAX_TOKENS, default_engine
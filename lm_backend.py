@@ -0,0 +1,313 @@
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from config import config
+from response_cache import response_cache
+from telemetry import registry
+
+request_seconds = registry.histogram("language_model_request_seconds", "Latency of chat completion requests")
+prompt_tokens_total = registry.counter("language_model_prompt_tokens_total", "Prompt tokens reported by the API")
+completion_tokens_total = registry.counter(
+    "language_model_completion_tokens_total", "Completion tokens reported by the API, or estimated for streams"
+)
+
+class CoalescedRequest:
+    def __init__(self, request):
+        self.request = request
+        self.n = 0
+        self.done = threading.Event()
+        self.choices = None
+        self.error = None
+
+class RequestCoalescer:
+    def __init__(self, send, window, max_n):
+        """
+        Merges identical requests from concurrent callers into one request for all their completions.
+        The first caller waits window seconds for others to join, then sends its request with the total n
+        and hands each caller its share of the choices.
+
+        Args:
+            send (callable): Sends a request, given the first caller's request and the total n, and returns the choices.
+            window (float): How long the first caller waits for identical requests.
+            max_n (int): The most completions merged into one request.
+        """
+        self.send = send
+        self.window = window
+        self.max_n = max_n
+        self.lock = threading.Lock()
+        self.open_requests = {}
+
+    def request(self, key, request, n):
+        with self.lock:
+            coalesced = self.open_requests.get(key)
+            is_leader = coalesced is None or coalesced.n + n > self.max_n
+            if is_leader:
+                coalesced = CoalescedRequest(request)
+                self.open_requests[key] = coalesced
+            start = coalesced.n
+            coalesced.n += n
+        if is_leader:
+            time.sleep(self.window)
+            with self.lock:
+                if self.open_requests.get(key) is coalesced:
+                    del self.open_requests[key]
+            try:
+                coalesced.choices = self.send(coalesced.request, coalesced.n)
+            except Exception as e:
+                coalesced.error = e
+            coalesced.done.set()
+        else:
+            coalesced.done.wait()
+        if coalesced.error is not None:
+            raise coalesced.error
+        return coalesced.choices[start:start + n]
+
+class LMBackend:
+    api_type = "open_ai"
+
+    def __init__(self):
+        """
+        Base class of the chat completion backends behind LanguageModel. Subclasses implement send and asend;
+        identical concurrent requests are merged into one n= request (see RequestCoalescer), and the
+        latency and token usage of every request are recorded in telemetry.registry.
+        """
+        self.coalescer = RequestCoalescer(
+            self.timed_send, config['language_model_coalesce_window'], config['language_model_max_coalesced_responses']
+        )
+
+    def send(self, kwargs, n):
+        """Sends one request for n completions. Returns the choices and the usage of the response (or None)."""
+        raise NotImplementedError
+
+    async def asend(self, kwargs):
+        """Sends one request asynchronously. Returns the choices (or the stream if kwargs has stream=True) and the usage."""
+        raise NotImplementedError
+
+    @staticmethod
+    def record_request(method, seconds, usage):
+        request_seconds.observe(seconds, method=method)
+        if usage:
+            prompt_tokens_total.inc(usage["prompt_tokens"])
+            completion_tokens_total.inc(usage["completion_tokens"])
+
+    def timed_send(self, kwargs, n):
+        start_time = time.perf_counter()
+        choices, usage = self.send(kwargs, n)
+        self.record_request("create", time.perf_counter() - start_time, usage)
+        return choices
+
+    def create(self, **kwargs):
+        """Like openai.ChatCompletion.create, but returns the choices, possibly from a request shared with other callers."""
+        # Requests differing only in n (and their timeout) are merged
+        key = repr(sorted((name, value) for name, value in kwargs.items() if name not in ("n", "timeout")))
+        return self.coalescer.request(key, kwargs, kwargs["n"])
+
+    async def acreate(self, **kwargs):
+        """Like openai.ChatCompletion.acreate, but returns the choices, or the stream if stream=True."""
+        start_time = time.perf_counter()
+        response, usage = await self.asend(kwargs)
+        self.record_request("acreate", time.perf_counter() - start_time, usage)
+        return response
+
+class OpenAIBackend(LMBackend):
+    def __init__(self, max_connections=32):
+        """
+        Sends chat completion requests to the OpenAI API over one pooled keep-alive HTTP session,
+        instead of a new session (and TLS handshake) for each thread that makes a request.
+        The openai package sends requests with `requests`, which doesn't support HTTP/2, so connections use HTTP/1.1.
+        openai and the key in api_key.py are only needed once this backend is created.
+        """
+        import openai
+        import requests
+        try:
+            from api_key import openai_key
+        except:
+            raise Exception("Create an api_key.py file with a dict including your OpenAI API key.")
+        super().__init__()
+        self.openai = openai
+        set_openai_key(openai, openai_key)
+        self.api_type = openai.api_type
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        openai.requestssession = self.session
+
+    def send(self, kwargs, n):
+        response = self.openai.ChatCompletion.create(**dict(kwargs, n=n))
+        return response.choices, response.get("usage")
+
+    async def asend(self, kwargs):
+        response = await self.openai.ChatCompletion.acreate(**kwargs)
+        # Streams don't report usage, so their prompt is estimated and their completion is counted by the reader
+        if kwargs.get("stream"):
+            return response, estimate_usage(kwargs, [])
+        return response.choices, response.get("usage")
+
+def set_openai_key(openai, openai_key):
+    """Sets OpenAI key."""
+    if 'api_type' in openai_key and openai_key['api_type'] == 'azure':
+        openai.api_type = "azure"
+        openai.api_version = "2023-03-15-preview"
+        openai.api_base = openai_key['api_base']
+    else:
+        if 'organization' in openai_key:
+            openai.organization = openai_key['organization']
+    openai.api_key = openai_key['api_key']
+
+class LocalMessage:
+    def __init__(self, content):
+        self.role = "assistant"
+        self.content = content
+
+class LocalChoice:
+    def __init__(self, index, content):
+        self.index = index
+        self.message = LocalMessage(content)
+        self.finish_reason = "stop"
+
+def estimate_usage(kwargs, contents):
+    """Estimates the usage of a response at four characters per token, for backends that don't count tokens."""
+    return {
+        "prompt_tokens": sum(len(message["content"]) for message in kwargs["messages"]) // 4,
+        "completion_tokens": sum(len(content) for content in contents) // 4,
+    }
+
+class LocalBackend(LMBackend):
+    api_type = "local"
+
+    def __init__(self, mode="template", template=None, url=None, latency=0.0, chunk_latency=0.0,
+                 error_rate=0.0, rate_limit_error_rate=0.0, chunk_chars=16, seed=0):
+        """
+        Answers chat completion requests without the OpenAI API, for offline runs and for load-testing
+        the rate limiter, retries and improver pipeline without spending money.
+
+        Args:
+            mode (str): "replay" answers with the cached responses to the same message (falling back to the template),
+                "template" formats the template, and "http" posts to an OpenAI-compatible server at url.
+            template (str): The response template, formatted with the last message and the largest code block in it.
+            url (str): The base URL of the local server, e.g. "http://localhost:8000/v1".
+            latency (float): The mean seconds before a response (or its first streamed chunk), exponentially distributed.
+            chunk_latency (float): The seconds between streamed chunks.
+            error_rate (float): The probability that a request fails with an error.
+            rate_limit_error_rate (float): The probability that a request fails with a rate limit error.
+            chunk_chars (int): The number of characters in each streamed chunk.
+            seed (int): The seed of the injected latencies and errors, which don't touch the global random state.
+        """
+        super().__init__()
+        assert mode in ("replay", "template", "http"), f"Unknown local backend mode {mode}"
+        self.mode = mode
+        self.template = template
+        self.url = url
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.chunk_chars = chunk_chars
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.replay_counter = {}
+        self.session = None
+
+    def draw_fault(self):
+        """Draws the latency of a request and the error it fails with, if any."""
+        with self.lock:
+            latency = self.random.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            draw = self.random.random()
+        if draw < self.rate_limit_error_rate:
+            return latency, Exception("Rate limit reached for local backend (injected)")
+        if draw < self.rate_limit_error_rate + self.error_rate:
+            return latency, Exception("Local backend error (injected)")
+        return latency, None
+
+    def respond_from_template(self, message, n):
+        from helpers import find_largest_code_block_line_by_line
+        code = find_largest_code_block_line_by_line(message) or ""
+        return [self.template.format(message=message, code=code)] * n
+
+    def respond_from_cache(self, message, temperature, n):
+        """Cycles through the cached responses of calls with the same message and temperature."""
+        cached = []
+        for n_cached in range(1, config['max_responses_per_call'] + 1):
+            key = hashlib.sha256(str((message, n_cached, temperature)).encode()).hexdigest()
+            if response_cache.has_entry(key, 0):
+                cached += response_cache.get(key, 0) or []
+        if not cached:
+            return self.respond_from_template(message, n)
+        with self.lock:
+            start = self.replay_counter.get(message, 0)
+            self.replay_counter[message] = start + n
+        return [cached[(start + i) % len(cached)] for i in range(n)]
+
+    def respond_from_server(self, kwargs, n):
+        import requests
+        if self.session is None:
+            self.session = requests.Session()
+        payload = {name: value for name, value in kwargs.items() if name not in ("timeout", "engine", "stream")}
+        payload["n"] = n
+        response = self.session.post(f"{self.url}/chat/completions", json=payload, timeout=kwargs.get("timeout"))
+        response.raise_for_status()
+        return [choice["message"]["content"] for choice in response.json()["choices"]]
+
+    def respond(self, kwargs, n):
+        message = kwargs["messages"][-1]["content"]
+        if self.mode == "replay":
+            return self.respond_from_cache(message, kwargs["temperature"], n)
+        if self.mode == "http":
+            return self.respond_from_server(kwargs, n)
+        return self.respond_from_template(message, n)
+
+    def send(self, kwargs, n):
+        latency, error = self.draw_fault()
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        contents = self.respond(kwargs, n)
+        return [LocalChoice(idx, content) for idx, content in enumerate(contents)], estimate_usage(kwargs, contents)
+
+    async def asend(self, kwargs):
+        latency, error = self.draw_fault()
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        loop = asyncio.get_running_loop()
+        contents = await loop.run_in_executor(None, self.respond, kwargs, kwargs["n"])
+        if kwargs.get("stream"):
+            return self.stream(contents), estimate_usage(kwargs, [])
+        return [LocalChoice(idx, content) for idx, content in enumerate(contents)], estimate_usage(kwargs, contents)
+
+    async def stream(self, contents):
+        """
+        Yields the contents of the choices in chunks shaped like those of openai.ChatCompletion.acreate(stream=True),
+        a chunk of each unfinished choice in turn, with a finish_reason on the last chunk of each.
+        """
+        n_chunks = max(max((len(content) - 1) // self.chunk_chars + 1, 1) for content in contents)
+        for chunk_idx in range(n_chunks):
+            if chunk_idx > 0:
+                await asyncio.sleep(self.chunk_latency)
+            start = chunk_idx * self.chunk_chars
+            for idx, content in enumerate(contents):
+                if start >= len(content) and start > 0:
+                    continue
+                finish_reason = "stop" if start + self.chunk_chars >= len(content) else None
+                yield {"choices": [
+                    {"index": idx, "delta": {"content": content[start:start + self.chunk_chars]}, "finish_reason": finish_reason}
+                ]}
+
+def create_backend(name):
+    """Creates the backend named by config['language_model_backend']."""
+    if name == "openai":
+        return OpenAIBackend()
+    if name == "local":
+        return LocalBackend(
+            mode=config['local_backend_mode'],
+            template=config['local_backend_template'],
+            url=config['local_backend_url'],
+            latency=config['local_backend_latency'],
+            chunk_latency=config['local_backend_chunk_latency'],
+            error_rate=config['local_backend_error_rate'],
+            rate_limit_error_rate=config['local_backend_rate_limit_error_rate'],
+        )
+    raise Exception(f"Unknown language model backend {name}")
@@ -0,0 +1,65 @@
+import time
+import asyncio
+import threading
+
+class TokenBucket:
+    def __init__(self, requests_per_second, tokens_per_minute, min_requests_per_second):
+        """
+        Rate limiter shared by every language model call in the process.
+
+        Requests and tokens are drawn from two buckets that refill continuously. Callers reserve
+        their share up front and then wait out any deficit, so concurrent callers queue up in
+        order instead of bursting. The request rate adapts across calls: it grows slowly on
+        success and backs off when the API reports a rate limit.
+
+        Args:
+            requests_per_second (float): The initial request rate.
+            tokens_per_minute (float): The token rate (prompt plus max completion tokens).
+            min_requests_per_second (float): The request rate never backs off below this.
+        """
+        self.lock = threading.Lock()
+        self.requests_per_second = requests_per_second
+        self.max_requests_per_second = requests_per_second * 4
+        self.min_requests_per_second = min_requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = 1.0
+        self.token_allowance = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_allowance = min(self.request_allowance + elapsed * self.requests_per_second, 1.0)
+        self.token_allowance = min(self.token_allowance + elapsed * self.tokens_per_minute / 60, self.tokens_per_minute)
+
+    def reserve(self, n_tokens):
+        """
+        Reserves one request and n_tokens tokens.
+
+        Returns:
+            wait_time (float): How many seconds the caller must wait before sending the request.
+        """
+        with self.lock:
+            self.refill()
+            # A single request larger than the whole bucket still goes through once it is full
+            n_tokens = min(n_tokens, self.tokens_per_minute)
+            self.request_allowance -= 1
+            self.token_allowance -= n_tokens
+            request_wait = max(-self.request_allowance, 0) / self.requests_per_second
+            token_wait = max(-self.token_allowance, 0) / (self.tokens_per_minute / 60)
+            return max(request_wait, token_wait)
+
+    def acquire(self, n_tokens):
+        time.sleep(self.reserve(n_tokens))
+
+    async def acquire_async(self, n_tokens):
+        await asyncio.sleep(self.reserve(n_tokens))
+
+    def on_success(self):
+        with self.lock:
+            self.requests_per_second = min(self.requests_per_second * 1.01, self.max_requests_per_second)
+
+    def on_rate_limited(self):
+        with self.lock:
+            self.requests_per_second = max(self.requests_per_second * 0.9, self.min_requests_per_second)
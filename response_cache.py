@@ -0,0 +1,107 @@
+import os
+import json
+import glob
+import sqlite3
+import threading
+import traceback
+import jsonlines
+
+class ResponseCache:
+    def __init__(self, path="cache/responses.sqlite"):
+        """
+        Persistent store of language model responses, shared by all processes using the same path.
+
+        Each cache key maps to an ordered list of entries, so the n-th repeated call with the same
+        key can replay the n-th stored response (see cache_counter in language_model.py).
+        The number of entries per key is indexed in memory once per process and only refreshed
+        from the database when a lookup goes past it, so hits never scan the cache directory.
+
+        Args:
+            path (str): The path of the SQLite database.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.entry_counts = {}
+
+    def connect(self):
+        """Opens the database, once per process (connections can't be shared across forks)."""
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        # WAL lets concurrent improver processes read while another one appends
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT, idx INTEGER, responses TEXT, PRIMARY KEY (key, idx))")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection = connection
+        self.pid = os.getpid()
+        self.import_jsonl_files()
+        self.entry_counts = dict(connection.execute("SELECT key, COUNT(*) FROM responses GROUP BY key"))
+        return connection
+
+    def import_jsonl_files(self):
+        """Imports the per-key cache/<key>.jsonl files written by older versions, exactly once."""
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute("SELECT value FROM meta WHERE name = 'imported_jsonl'").fetchone() is None:
+                for cache_file in glob.glob(os.path.join(os.path.dirname(self.path), "*.jsonl")):
+                    key = os.path.basename(cache_file)[:-len(".jsonl")]
+                    try:
+                        with jsonlines.open(cache_file) as reader:
+                            entries = [entry for entry in reader]
+                    except Exception as e:
+                        print("Failed to import cache file", cache_file, "with exception", e)
+                        continue
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO responses VALUES (?, ?, ?)",
+                        [(key, idx, json.dumps(entry)) for idx, entry in enumerate(entries)]
+                    )
+                connection.execute("INSERT INTO meta VALUES ('imported_jsonl', '1')")
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def has_entry(self, key, idx):
+        """Returns whether the key has an entry at position idx."""
+        with self.lock:
+            connection = self.connect()
+            if self.entry_counts.get(key, 0) > idx:
+                return True
+            # Another process may have appended since we built the index
+            count = connection.execute("SELECT COUNT(*) FROM responses WHERE key = ?", (key,)).fetchone()[0]
+            self.entry_counts[key] = count
+            return count > idx
+
+    def get(self, key, idx):
+        """Returns the entry at position idx for the key, or None if it is missing or unreadable."""
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT responses FROM responses WHERE key = ? AND idx = ?", (key, idx)).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except Exception as e:
+            print("Failed to read from cache with exception", e)
+            print("Traceback:", traceback.format_exc())
+            return None
+
+    def append(self, key, responses):
+        """Appends an entry for the key, atomically with respect to other processes."""
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                idx = connection.execute("SELECT COUNT(*) FROM responses WHERE key = ?", (key,)).fetchone()[0]
+                connection.execute("INSERT INTO responses VALUES (?, ?, ?)", (key, idx, json.dumps(responses)))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self.entry_counts[key] = idx + 1
+
+response_cache = ResponseCache()
@@ -7,9 +7,17 @@ from helpers import (
 from config import config
 from pebble import ProcessPool as Pool
 import multiprocess
-from language_model import cache_counter, LanguageModel
+from language_model import cache_counter, LanguageModel, SharedBudget
+from collections import defaultdict
+from usage_log import usage_log
+from telemetry import registry
+from blob_store import blob_store
+from checkpoint import save_checkpoint, load_checkpoint
 import time
 import os
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 import argparse
 
@@ -17,23 +25,29 @@ use_seed_algorithm = config["use_seed_algorithm"]
 task = config["task"]
 
 utility_str, secret_utility_str = get_utility_strs(task)
-from tasks.meta_optimization.secret_utility import meta_utility
-# Wipe usage_log.jsonl
-with open("usage_log.jsonl", "w") as f:
-    f.write("")
+from tasks.meta_optimization.secret_utility import meta_utility, make_meta_utility
+# Start a fresh usage log, keeping the previous run's one rotated aside
+usage_log.rotate()
 
-def pre_utility_hook(cur_utility_fn):
+def pre_utility_hook(cur_utility_fn, shared_budget=None):
     """
     A hook function that resets the usage count of the current utility function,
     initializes a new language model, and clears the cache counter.
+    With a shared_budget, i.e. for a lineage of a population, the language model gets a cache counter of its own,
+    since the lineages run concurrently and would otherwise clear and advance each other's counts.
 
     Args:
         cur_utility_fn: The current utility function.
+        shared_budget: A budget shared with other lineages that the language model's calls also count against, if any.
 
     Returns:
         A new language model.
     """
     cur_utility_fn.uses = 0
+    if shared_budget is not None:
+        return LanguageModel(
+            budget=config['language_model_call_budget'], shared_budget=shared_budget, cache_counter=defaultdict(int)
+        )
     language_model = LanguageModel(budget=config['language_model_call_budget'])
     cache_counter.clear()
     return language_model
@@ -119,17 +133,21 @@ def initialize_seed_list(resume_from):
     seed_list = [f for _, f in seed_zip]
     return seed_list, start_iter
 
-def attempt_algorithm_improvement(algorithm_to_improve, cur_utility_fn, improve_algorithm, previous_improve_algorithm):
+def attempt_algorithm_improvement(
+    algorithm_to_improve, cur_utility_fn, improve_algorithm, previous_improve_algorithm, language_model_budget=None
+):
     """
     Attempts to improve the given algorithm using the specified improve algorithm.
 
     Returns:
-        A tuple containing a boolean indicating whether the improvement was successful, the new algorithm string, and the improve algorithm used.
+        A tuple containing a boolean indicating whether the improvement was successful, the new algorithm string,
+        the improve algorithm used, and the checked utility of the new algorithm (None if it failed before being checked).
     """
     pool = initialize_pool(config["use_timeout_in_improver"])
-    language_model = pre_utility_hook(cur_utility_fn)
+    language_model = pre_utility_hook(cur_utility_fn, language_model_budget)
     successful_improvement = False
     new_algorithm_str = None
+    checked_utility = None
     
     try:
         if config["use_timeout_in_improver"]:
@@ -137,7 +155,7 @@ def attempt_algorithm_improvement(algorithm_to_improve, cur_utility_fn, improve_
             new_algorithm_str = new_algorithm_future.result(timeout=2 * 60 * 60)
         else:
             new_algorithm_str = improve_algorithm(algorithm_to_improve, cur_utility_fn, language_model)
-        language_model = pre_utility_hook(cur_utility_fn)
+        language_model = pre_utility_hook(cur_utility_fn, language_model_budget)
         checked_utility = cur_utility_fn(new_algorithm_str, log_usage=True)
         if checked_utility == 0:
             raise Exception("Checked utility is 0")
@@ -147,36 +165,199 @@ def attempt_algorithm_improvement(algorithm_to_improve, cur_utility_fn, improve_
         improve_algorithm = previous_improve_algorithm
 
     end_pool_if_used(pool, join_pools=config["join_pools"])
-    return successful_improvement, new_algorithm_str, improve_algorithm
+    return successful_improvement, new_algorithm_str, improve_algorithm, checked_utility
 
-def run_improver_main(resume_from=None):
+def write_telemetry():
+    """Appends a snapshot of the telemetry to the run's telemetry.jsonl and rewrites its metrics.prom."""
+    try:
+        registry.write_jsonl(f"results/{run_id}/telemetry.jsonl")
+        registry.write_prometheus(f"results/{run_id}/metrics.prom")
+    except Exception as e:
+        print("Failed to write telemetry with exception", e)
+        print(traceback.format_exc())
+
+def save_iteration_algorithm(kind, algorithm_str, cur_iter):
+    """Indexes an algorithm of an iteration in blob_store, next to the copy in results/ that resuming reads."""
+    try:
+        blob_store.record(kind, algorithm_str, run_id=run_id, iteration=cur_iter)
+    except Exception as e:
+        print("Failed to save algorithm with exception", e)
+        print(traceback.format_exc())
+
+def load_improver(improve_algorithm_str):
+    """Returns the improve_algorithm defined in improve_algorithm_str, or the seed improver if it is None."""
+    if improve_algorithm_str is None:
+        return initial_improve_algorithm
+    return temp_override(improve_algorithm_str, "improve_algorithm")
+
+def initialize_state(resume_from):
     """
-    The main function for the improver. Iteratively improves the target algorithm using the improve algorithm.
-    If self target is enabled, the algorithm being improved is the same as the improve algorithm.
+    Returns the state to start iterating from: the last checkpoint of resume_from if it has one,
+    or else the state rebuilt from its results/ files (or from the seeds, for a new run).
+    Improvers are stored as strings, with None standing for the seed improver.
     """
+    checkpoint = load_checkpoint(resume_from) if resume_from is not None else None
+    if checkpoint is not None:
+        print("Resuming from the checkpoint before iteration", checkpoint["next_iter"])
+        meta_utility.uses = checkpoint["meta_utility_uses"]
+        cache_counter.clear()
+        cache_counter.update(checkpoint["cache_counter"])
+        return checkpoint
+
     is_new_run = resume_from is None
     evaluated_initial_utility = not is_new_run
     cur_utility_fn = meta_utility
     seed_list, start_iter = initialize_seed_list(resume_from)
     improver_str, algorithm_to_improve, improve_algorithm, evaluated_initial_utility = get_from_seed(
         seed_list, evaluated_initial_utility, cur_utility_fn)
-    _, _, previous_improve_algorithm, evaluated_initial_utility = get_from_seed(
+    previous_improver_str, _, previous_improve_algorithm, evaluated_initial_utility = get_from_seed(
         seed_list, evaluated_initial_utility, cur_utility_fn)
+    return {
+        "next_iter": start_iter,
+        "improver_str": improver_str,
+        "algorithm_to_improve": algorithm_to_improve,
+        "improve_algorithm_str": None if improve_algorithm is initial_improve_algorithm else improver_str,
+        "previous_improve_algorithm_str": (
+            None if previous_improve_algorithm is initial_improve_algorithm else previous_improver_str
+        ),
+        "history": [],
+    }
 
-    for cur_iter in range(start_iter, config["n_iterations"]):
+def run_improver_main(resume_from=None):
+    """
+    The main function for the improver. Iteratively improves the target algorithm using the improve algorithm.
+    If self target is enabled, the algorithm being improved is the same as the improve algorithm.
+    The state is checkpointed after every iteration, so a resumed run continues from the last finished one.
+    """
+    cur_utility_fn = meta_utility
+    state = initialize_state(resume_from)
+    improve_algorithm = load_improver(state["improve_algorithm_str"])
+    previous_improve_algorithm = load_improver(state["previous_improve_algorithm_str"])
+
+    def checkpoint(next_iter):
+        state["next_iter"] = next_iter
+        state["meta_utility_uses"] = getattr(meta_utility, "uses", 0)
+        state["cache_counter"] = dict(cache_counter)
+        try:
+            save_checkpoint(run_id, state)
+        except Exception as e:
+            print("Failed to save checkpoint with exception", e)
+            print(traceback.format_exc())
+
+    checkpoint(state["next_iter"])
+    for cur_iter in range(state["next_iter"], config["n_iterations"]):
+        registry.set_context(run_id=run_id, iteration=cur_iter)
+        algorithm_to_improve = state["algorithm_to_improve"]
         write_str_to_file(algorithm_to_improve, f"results/{run_id}/seed_algorithm_{cur_iter}.py")
-        successful_improvement, new_algorithm_str, improve_algorithm = attempt_algorithm_improvement(
+        save_iteration_algorithm("seed_algorithm", algorithm_to_improve, cur_iter)
+        successful_improvement, new_algorithm_str, improve_algorithm, checked_utility = attempt_algorithm_improvement(
             algorithm_to_improve, cur_utility_fn, improve_algorithm, previous_improve_algorithm
         )
+        state["history"].append({"iteration": cur_iter, "successful": successful_improvement, "utility": checked_utility})
 
         if successful_improvement:
             # Save algorithm to file
             write_str_to_file(new_algorithm_str, f"results/{run_id}/improved_algorithm_{cur_iter}.py")
+            save_iteration_algorithm("improved_algorithm", new_algorithm_str, cur_iter)
             if config["iterative"]:
-                improver_str = new_algorithm_str
-            algorithm_to_improve = new_algorithm_str
+                state["improver_str"] = new_algorithm_str
+            state["algorithm_to_improve"] = new_algorithm_str
             previous_improve_algorithm = improve_algorithm
-            improve_algorithm = temp_override(improver_str, "improve_algorithm")
+            state["previous_improve_algorithm_str"] = state["improve_algorithm_str"]
+            improve_algorithm = temp_override(state["improver_str"], "improve_algorithm")
+            state["improve_algorithm_str"] = state["improver_str"]
+        else:
+            # attempt_algorithm_improvement fell back to the previous improver
+            state["improve_algorithm_str"] = state["previous_improve_algorithm_str"]
+        write_telemetry()
+        checkpoint(cur_iter + 1)
+
+def attempt_lineage_improvement(lineage, child_id, meta_utility_budget, language_model_budget):
+    """
+    Attempts to improve the algorithm of a lineage of the population, with its own meta-utility.
+
+    Returns:
+        The child lineage, or None if the attempt failed.
+    """
+    cur_utility_fn = make_meta_utility(meta_utility_budget)
+    successful_improvement, new_algorithm_str, _, checked_utility = attempt_algorithm_improvement(
+        lineage["algorithm_to_improve"], cur_utility_fn, load_improver(lineage["improve_algorithm_str"]),
+        load_improver(lineage["previous_improve_algorithm_str"]), language_model_budget
+    )
+    if not successful_improvement:
+        return None
+    improver_str = new_algorithm_str if config["iterative"] else lineage["improver_str"]
+    return {
+        "id": child_id,
+        "parent": lineage["id"],
+        "improver_str": improver_str,
+        "algorithm_to_improve": new_algorithm_str,
+        "improve_algorithm_str": improver_str,
+        "previous_improve_algorithm_str": lineage["improve_algorithm_str"],
+        "score": checked_utility,
+    }
+
+def select_population(candidates, population_size, selection, rng):
+    """
+    Selects the next generation from the parents and their children, by their meta-utility:
+    the best population_size ("top_k"), or the winners of population_size tournaments ("tournament").
+    Lineages that were never scored (the seeds) rank last.
+    """
+    score = lambda lineage: lineage["score"] if lineage["score"] is not None else float("-inf")
+    if selection == "top_k":
+        return sorted(candidates, key=score, reverse=True)[:population_size]
+    if selection == "tournament":
+        tournament_size = min(config["population_tournament_size"], len(candidates))
+        return [max(rng.sample(candidates, tournament_size), key=score) for _ in range(population_size)]
+    raise Exception(f"Unknown population selection {selection}")
+
+def run_population_main():
+    """
+    Population version of run_improver_main: keeps config['population_size'] lineages and, every generation,
+    attempts to improve all of them concurrently, then selects the next generation from them and their children.
+    The lineages share the meta-utility and language model call budgets config['population_*_budget'],
+    and the rate limiter, so together they keep the API quota and the worker pool busy.
+    """
+    population_size = config["population_size"]
+    state = initialize_state(None)
+    population = [
+        {
+            "id": f"seed_{lineage_idx}",
+            "parent": None,
+            "improver_str": state["improver_str"],
+            "algorithm_to_improve": state["algorithm_to_improve"],
+            "improve_algorithm_str": state["improve_algorithm_str"],
+            "previous_improve_algorithm_str": state["previous_improve_algorithm_str"],
+            "score": None,
+        }
+        for lineage_idx in range(population_size)
+    ]
+    meta_utility_budget = SharedBudget(config["population_meta_utility_budget"])
+    language_model_budget = SharedBudget(config["population_language_model_budget"])
+    executor = ThreadPoolExecutor(max_workers=config["population_workers"] or population_size)
+    for generation in range(config["n_iterations"]):
+        registry.set_context(run_id=run_id, iteration=generation)
+        futures = [
+            executor.submit(
+                attempt_lineage_improvement, lineage, f"{generation}_{lineage_idx}", meta_utility_budget, language_model_budget
+            )
+            for lineage_idx, lineage in enumerate(population)
+        ]
+        children = []
+        for future in futures:
+            try:
+                child = future.result()
+            except Exception as e:
+                print("Exception in improving lineage:", e, "\n", traceback.format_exc())
+                continue
+            if child is not None:
+                children.append(child)
+                save_iteration_algorithm("improved_algorithm", child["algorithm_to_improve"], generation)
+        population = select_population(population + children, population_size, config["population_selection"], random.Random(generation))
+        print(f"Generation {generation}: {len(children)} children, scores", [lineage["score"] for lineage in population])
+        write_str_to_file(json.dumps(population), f"results/{run_id}/population_{generation}.json")
+        write_telemetry()
+    executor.shutdown()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -200,4 +381,7 @@ if __name__ == "__main__":
         )
         # Create a folder for the results
         os.makedirs(f"results/{run_id}", exist_ok=True)
-    run_improver_main()
\ No newline at end of file
+    if config["population_size"]:
+        run_population_main()
+    else:
+        run_improver_main(resume_from)
\ No newline at end of file
@@ -1,10 +1,125 @@
 import random
 import numpy as np
-from helpers import temp_override, read_file_as_str
-from pebble import ThreadPool
+from helpers import temp_override, read_file_as_str, batch_evaluate, race_evaluate
+from instance_bank import get_instances, get_random_states, select_instances
+from utility_memo import memoize_utility
+from worker_pool import worker_pool
 from config import config
 
-def utility(algorithm_str: str, mode: str = "val"):
+def draw_words(seed, n_words):
+    """
+    Draws the first n_words 32-bit outputs of the Mersenne Twister that random.seed(seed) initializes,
+    in the order random.random() and random.randint would consume them.
+    Returns them along with the generator, which is left right after those draws.
+    """
+    generator = random.Random(seed)
+    # getrandbits fills its result with whole words, least significant first
+    words = np.frombuffer(generator.getrandbits(32 * n_words).to_bytes(4 * n_words, "little"), dtype="<u4")
+    return words.astype(np.int64), generator
+
+def decode_randint(words, a, b):
+    """
+    Decodes random.randint(a, b) from the start of a word stream: it draws getrandbits(k) = word >> (32 - k)
+    until the result is below b - a + 1. Returns the value and the number of words used, or None if the stream is too short.
+    """
+    n_choices = b - a + 1
+    candidates = words >> (32 - n_choices.bit_length())
+    accepted = np.flatnonzero(candidates < n_choices)
+    if len(accepted) == 0:
+        return None
+    return a + int(candidates[accepted[0]]), int(accepted[0]) + 1
+
+def decode_edges(words, n_nodes, p_edge, max_weight):
+    """
+    Decodes the adjacency matrix that drawing random.random() < p_edge and then random.randint(1, max_weight)
+    for each node pair in order would produce from a word stream.
+    Returns the adjacency matrix and the number of words used, or None if the stream is too short.
+    """
+    n_words = len(words)
+    n_pairs = n_nodes * (n_nodes - 1) // 2
+    if n_pairs == 0:
+        return np.zeros((n_nodes, n_nodes)), 0
+    # random.random() combines the top 27 and 26 bits of two consecutive words
+    is_edge = ((words[:-1] >> 5) * 67108864 + (words[1:] >> 6)) / 9007199254740992 < p_edge
+    weight_candidates = words >> (32 - max_weight.bit_length())
+    positions = np.arange(n_words + 1, dtype=np.int32)
+    is_accepted_weight = np.append(weight_candidates < max_weight, True)
+    first_accepted_weight = np.minimum.accumulate(np.where(is_accepted_weight, positions, n_words)[::-1])[::-1]
+
+    # Where the draws of the next pair start, given those of a pair start at some position
+    next_start = np.full(n_words + 1, n_words, dtype=np.int32)
+    pair_positions = positions[:n_words - 1]
+    next_start[:n_words - 1] = np.where(
+        is_edge, first_accepted_weight[np.minimum(pair_positions + 2, n_words)] + 1, pair_positions + 2
+    )
+    np.minimum(next_start, n_words, out=next_start)
+
+    # The k-th pair starts at next_start applied k times to 0: walk the chain 64 pairs at a time
+    # with next_start composed 64 times, then fill in the pairs of all strides at once
+    stride = 64
+    stride_jump = next_start
+    for _ in range(stride.bit_length() - 1):
+        stride_jump = stride_jump[stride_jump]
+    n_strides = -(-n_pairs // stride)
+    stride_starts = np.zeros(n_strides, dtype=np.int32)
+    for stride_idx in range(1, n_strides):
+        stride_starts[stride_idx] = stride_jump[stride_starts[stride_idx - 1]]
+    pair_starts = np.empty((n_strides, stride), dtype=np.int32)
+    current_starts = stride_starts
+    for offset in range(stride):
+        pair_starts[:, offset] = current_starts
+        current_starts = next_start[current_starts]
+    pair_starts = pair_starts.reshape(-1)[:n_pairs]
+    end = next_start[pair_starts[-1]]
+    if end >= n_words:
+        return None
+
+    edges = is_edge[pair_starts]
+    weights = weight_candidates[first_accepted_weight[pair_starts[edges] + 2]] + 1
+    rows, cols = np.triu_indices(n_nodes, 1)
+    adjacency_matrix = np.zeros((n_nodes, n_nodes))
+    adjacency_matrix[rows[edges], cols[edges]] = weights
+    adjacency_matrix[cols[edges], rows[edges]] = weights
+    return adjacency_matrix, int(end)
+
+def generate_instance(seed, min_n_nodes, max_n_nodes, p_edge, max_weight):
+    """
+    Generates a random weighted graph, bit-identical to seeding `random` with seed and drawing its
+    size and edges with random.randint / random.random one pair at a time, but vectorized.
+    Also returns the state `random` is left in (see get_random_states), so algorithms see the same randomness as before.
+    """
+    n_words = 64
+    decoded = None
+    while decoded is None:
+        words, _ = draw_words(seed, n_words)
+        decoded = decode_randint(words, min_n_nodes, max_n_nodes)
+        if decoded is not None:
+            n_nodes, n_used = decoded
+            # Each pair uses two words, plus a weight draw (1.6 words on average) for edges
+            n_pairs = n_nodes * (n_nodes - 1) // 2
+            n_words = max(n_words, n_used + 64 + int(n_pairs * (2 + 2 * p_edge)))
+            words, _ = draw_words(seed, n_words)
+            decoded = decode_edges(words[n_used:], n_nodes, p_edge, max_weight)
+        n_words *= 2
+    adjacency_matrix, n_used_edges = decoded
+    _, generator = draw_words(seed, n_used + n_used_edges)
+    return {"adjacency_matrix": adjacency_matrix, "random_state": np.array(generator.getstate()[1], dtype=np.uint32)}
+
+def compute_cut_weight(adjacency_matrix, partition):
+    """Sums the weights of the edges between nodes in different parts."""
+    partition_array = np.asarray(partition)
+    if partition_array.ndim == 1 and partition_array.dtype.kind in "biuf":
+        # The weights are integers, so this matches the pairwise sum exactly
+        return np.sum(adjacency_matrix[partition_array[:, None] != partition_array[None, :]]) / 2
+    n_nodes = len(adjacency_matrix)
+    cut_weight = 0
+    for i in range(n_nodes):
+        for j in range(i+1, n_nodes):
+            if partition[i] != partition[j]:
+                cut_weight += adjacency_matrix[i, j]
+    return cut_weight
+
+def utility(algorithm_str: str, mode: str = "val", instance_range=None):
     """
     Implements the Max-Cut utility function. Returns the average cut weight.
     If the algorithm requires more than 100 milliseconds to run per test, it is a failure.
@@ -21,44 +136,44 @@ def utility(algorithm_str: str, mode: str = "val"):
     n_tests = 100
     min_n_nodes = 50
     max_n_nodes = 200
+    p_edge = 0.4
+    max_weight = 10
     average_cut_weight = 0
     base_seed = 4321 if mode == "val" else 5678
-    pool = ThreadPool()
     eps = 1e-2
 
     try:
-        algorithm = temp_override(algorithm_str, "algorithm")
+        temp_override(algorithm_str, "algorithm", in_worker=True)
     except Exception as e:
         return eps
 
-    for test_idx in range(n_tests):
-        random.seed(base_seed + test_idx)  # Consistent seeding for evaluation
-        np.random.seed(base_seed + test_idx)
-
-        n_nodes = random.randint(min_n_nodes, max_n_nodes)
-        p_edge = 0.4
-        max_weight = 10
-
-        # Generate random adjacency matrix
-        adjacency_matrix = np.zeros((n_nodes, n_nodes))
-        for i in range(n_nodes):
-            for j in range(i+1, n_nodes):
-                if random.random() < p_edge:
-                    weight = random.randint(1, max_weight)
-                    adjacency_matrix[i, j] = weight
-                    adjacency_matrix[j, i] = weight
+    params = {
+        "base_seed": base_seed, "n_tests": n_tests, "min_n_nodes": min_n_nodes,
+        "max_n_nodes": max_n_nodes, "p_edge": p_edge, "max_weight": max_weight,
+    }
+    instances = get_instances("maxcut", params, lambda: [
+        generate_instance(base_seed + test_idx, min_n_nodes, max_n_nodes, p_edge, max_weight)
+        for test_idx in range(n_tests)
+    ])
+    first_test_idx, instances = select_instances(instances, instance_range)
+    n_tests = len(instances)
+    for test_idx, instance in enumerate(instances, start=first_test_idx):
+        # Consistent seeding for evaluation: the algorithm sees random and np.random as generating the instance would leave them
+        random_states = get_random_states(instance, np_seed=base_seed + test_idx)
+        adjacency_matrix = instance["adjacency_matrix"]
+        n_nodes = len(adjacency_matrix)
 
         # Run the algorithm to find the partition
         try:
-            partition_future = pool.schedule(algorithm, (adjacency_matrix,))
-            partition = partition_future.result(timeout=0.1)
+            partition, elapsed = worker_pool.run_timed(
+                algorithm_str, "algorithm", (adjacency_matrix,), budget=0.1, clock="process_cpu",
+                random_states=random_states
+            )
+            if elapsed > 0.1:
+                return eps
             if len(partition) != n_nodes:
                 return 0
-            cut_weight = 0
-            for i in range(n_nodes):
-                for j in range(i+1, n_nodes):
-                    if partition[i] != partition[j]:
-                        cut_weight += adjacency_matrix[i, j]
+            cut_weight = compute_cut_weight(adjacency_matrix, partition)
         except Exception as e:
             if e.__class__.__name__ != "TimeoutError":
                 print("Exception:", e)
@@ -68,7 +183,12 @@ def utility(algorithm_str: str, mode: str = "val"):
 
     return max(average_cut_weight, eps)
 
+utility = memoize_utility(utility, "maxcut", read_file_as_str(f"tasks/maxcut/secret_utility.py"))
 utility.budget = config["utility_budget"]
 fake_self_str = read_file_as_str(f"tasks/maxcut/utility.py")
 utility.str = fake_self_str
-utility.uses = 0
\ No newline at end of file
+utility.uses = 0
+utility.batch = lambda algorithm_strs, mode="val": batch_evaluate(utility, algorithm_strs, mode)
+utility.n_instances = {"val": 100, "test": 100}
+utility.target = ("algorithm", 1)
+utility.race = lambda algorithm_strs, mode="val": race_evaluate(utility, algorithm_strs, mode)
@@ -1,5 +1,3 @@
-from helpers import extract_code
-
 def improve_algorithm(initial_solution, utility, language_model):
     """Improves a solution according to a utility function."""
     expertise = "You are an expert computer science researcher and programmer, especially skilled at optimizing algorithms."
@@ -16,8 +14,12 @@ You will be evaluated based on this score function:
 You must return an improved solution. Be as creative as you can under the constraints.
 Your primary improvement must be novel and non-trivial. First, propose an idea, then implement it."""
     n_messages = min(language_model.max_responses_per_call, utility.budget)
-    new_solutions = language_model.batch_prompt(expertise, [message] * n_messages, temperature=0.7)
-    new_solutions = extract_code(new_solutions)
+    # Race the solutions on growing prefixes of the instances as they are generated, so scoring overlaps
+    # generation and the weak ones stop early
+    new_solutions, results = utility.race(language_model.stream_prompt(expertise, message, n_messages, temperature=0.7))
+    if not new_solutions:
+        return initial_solution
     print("new_solutions:", new_solutions)
-    best_solution = max(new_solutions, key=utility)
+    # A dropped solution's score is only over the instances it ran on, so finished solutions rank first
+    best_solution = max(zip(results, new_solutions), key=lambda scored: (scored[0][1], scored[0][0]))[1]
     return best_solution
\ No newline at end of file
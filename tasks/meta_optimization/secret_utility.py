@@ -1,15 +1,17 @@
-from pebble import ThreadPool
+from pebble import ProcessPool
+import multiprocess
 import numpy as np
 import os
 import time
 import traceback
 from language_model import LanguageModel
+from telemetry import registry
 from tqdm import tqdm
 
 from config import config
 from helpers import (
     read_file_as_str, generate_seed_algorithm, write_str_to_file,
-    temp_override, end_pool_if_used, write_log
+    temp_override, end_pool_if_used, write_log, batch_evaluate, race_evaluate, save_test_algorithms, count_use
 )
 
 # Suppress warnings
@@ -62,75 +64,147 @@ def create_handled_fn(fn, handle_exceptions, log_usage, pool, timeout=None, fail
             return fail_value
     return handled_fn
 
+def run_meta_utility_test(improve_str: str, mode: str = "val", log_usage: bool = False, handle_exceptions: bool = True):
+    """
+    Runs one meta-utility test: improves the base algorithm with improve_str and evaluates the result.
+    Each test gets its own utility function (and use counter) and language model budget,
+    so tests can run in separate worker processes.
+
+    Returns:
+        A tuple of the improved algorithm string, its val utility and its test utility (0 unless log_usage).
+        If an exception is not handled, the exception is returned in place of the algorithm string.
+    """
+    utility = temp_override(base_secret_utility_str, "utility")
+    language_model = pre_utility_hook(utility)
+    get_improver_wrapped = create_handled_fn(get_improver, handle_exceptions, log_usage, None)
+    improved_algorithm_str = get_improver_wrapped(improve_str, utility, mode, language_model)
+    if isinstance(improved_algorithm_str, Exception) or not improved_algorithm_str:
+        return improved_algorithm_str, 0, 0
+    utility.uses = 0
+    utility_wrapped = create_handled_fn(utility, handle_exceptions, log_usage, None, fail_value=0)
+    new_utility_val = utility_wrapped(improved_algorithm_str, mode="val")
+    if isinstance(new_utility_val, Exception):
+        return new_utility_val, 0, 0
+    new_utility_test = 0
+    # Also log test
+    if log_usage:
+        print("Evaluating improved algorithm on test")
+        utility.uses = 0
+        new_utility_test = utility_wrapped(improved_algorithm_str, mode="test")
+    return improved_algorithm_str, new_utility_val, new_utility_test
+
+def run_meta_utility_test_in_worker(context, test_idx, *args):
+    """
+    Runs a meta-utility test in a worker process, and returns its result with a snapshot of the telemetry
+    it recorded, to be merged into the parent's registry.
+    """
+    registry.reset()
+    registry.context = dict(context, test_idx=test_idx)
+    return run_meta_utility_test(*args), registry.snapshot()
+
+meta_utility_pool = None
+
+def start_meta_utility_pool():
+    """
+    Starts the process pool used to run meta-utility tests in parallel.
+    Workers are forked right away, since temp_override's reliability_guard later disables os.fork
+    in this process. They are reused for every meta-utility call.
+    """
+    global meta_utility_pool
+    if meta_utility_pool is None:
+        meta_utility_pool = ProcessPool(max_workers=config['meta_utility_tests'], context=multiprocess.get_context('fork'))
+        meta_utility_pool.schedule(int).result()
+    return meta_utility_pool
+
 def meta_utility(improve_str: str, mode: str = "val", log_usage: bool = False, handle_exceptions: bool = True):
     """
     Uses the improvement algorithm in improve_str to improve the algorithm in algorithm_str, according to the utility function.
     """
-    meta_utility.uses = getattr(meta_utility, "uses", 0) + 1
-    if meta_utility.uses > meta_utility.budget:
+    if not count_use(meta_utility):
         print("Ran out of uses for meta-utility.")
         return 0
+    return evaluate_improver(improve_str, mode, log_usage, handle_exceptions)
+
+def make_meta_utility(shared_budget=None):
+    """
+    Returns a meta-utility with its own uses and budget, like meta_utility, so that concurrent lineages
+    of a population don't share a use counter. Calls also count against shared_budget, if given.
+    """
+    def lineage_meta_utility(improve_str: str, mode: str = "val", log_usage: bool = False, handle_exceptions: bool = True):
+        if not count_use(lineage_meta_utility) or (shared_budget is not None and not shared_budget.take()):
+            print("Ran out of uses for meta-utility.")
+            return 0
+        return evaluate_improver(improve_str, mode, log_usage, handle_exceptions)
+    lineage_meta_utility.budget = meta_utility.budget
+    lineage_meta_utility.str = meta_utility.str
+    lineage_meta_utility.uses = 0
+    lineage_meta_utility.target = meta_utility.target
+    lineage_meta_utility.batch = lambda improve_strs, mode="val": batch_evaluate(
+        lineage_meta_utility, improve_strs, mode, max_parallel=1
+    )
+    lineage_meta_utility.race = lambda improve_strs, mode="val": race_evaluate(
+        lineage_meta_utility, improve_strs, mode, max_parallel=1
+    )
+    return lineage_meta_utility
+
+def evaluate_improver(improve_str: str, mode: str = "val", log_usage: bool = False, handle_exceptions: bool = True):
+    """Computes the meta-utility of improve_str, without counting it against a budget."""
     if not improve_str:
         print(f"improve_str is {repr(improve_str)}, returning 0")
         return 0
     n_tests = config['meta_utility_tests']
-    use_timeout = False
-    use_parallel = False
-    # We can't use parallelism if we're not using timeout
-    assert not (use_parallel and not use_timeout)
+    use_parallel = config['meta_utility_parallel']
     expected_utility_val = 0
     expected_utility_test = 0
     eval_idx = str(int(time.time()))
     run_id = max([results_folder for results_folder in os.listdir("results")], key=lambda x: int(x.split("_")[0]))
-    utility = temp_override(base_secret_utility_str, "utility")
 
-    pool = ThreadPool() if use_timeout else None
-    improved_algorithm_futures = []
-    improved_algorithm_strs = []
+    test_results = []
     if use_parallel:
-        for test_idx in tqdm(range(n_tests)):
-            language_model = pre_utility_hook(utility)
-            improved_algorithm_future = pool.schedule(get_improver, (improve_str, utility, mode, language_model))
-            improved_algorithm_futures.append(improved_algorithm_future)
-        for improved_algorithm_future in improved_algorithm_futures:
-            utility.uses = 0  # In case utility points to the same object each time
-            get_improver_wrapped = create_handled_fn(improved_algorithm_future.result, handle_exceptions, log_usage, pool)()
-            improved_algorithm_str = get_improver_wrapped(timeout=60 * 60)
-            if isinstance(improved_algorithm_str, Exception):
+        pool = start_meta_utility_pool()
+        test_futures = [
+            pool.schedule(
+                run_meta_utility_test_in_worker,
+                (registry.context, test_idx, improve_str, mode, log_usage, handle_exceptions)
+            )
+            for test_idx in range(n_tests)
+        ]
+        for test_future in tqdm(test_futures):
+            # The pool is shared across calls, so it is not stopped on failure
+            get_test_result = create_handled_fn(
+                test_future.result, handle_exceptions, log_usage, None, fail_value=(("", 0, 0), None)
+            )
+            test_output = get_test_result(timeout=60 * 60)
+            if isinstance(test_output, Exception):
                 return 0
-            improved_algorithm_strs.append(improved_algorithm_str)
+            test_result, telemetry_snapshot = test_output
+            if telemetry_snapshot is not None:
+                registry.merge(telemetry_snapshot)
+            test_results.append(test_result)
     else:
         for test_idx in tqdm(range(n_tests)):
-            language_model = pre_utility_hook(utility)
-            timeout = 60 * 60 if use_timeout else None
-            get_improver_wrapped = create_handled_fn(get_improver, handle_exceptions, log_usage, pool, timeout=timeout)
-            improved_algorithm_str = get_improver_wrapped(improve_str, utility, mode, language_model)
-            if isinstance(improved_algorithm_str, Exception):
+            registry.set_context(test_idx=test_idx)
+            test_result = run_meta_utility_test(improve_str, mode, log_usage, handle_exceptions)
+            # Stop at the first failure, rather than spending the budget of the remaining tests
+            if isinstance(test_result[0], Exception):
+                registry.set_context(test_idx=None)
                 return 0
-            improved_algorithm_strs.append(improved_algorithm_str)
-    end_pool_if_used(pool, join_pools=config["join_pools"])
-    for test_idx, improved_algorithm_str in enumerate(improved_algorithm_strs):
+            test_results.append(test_result)
+        registry.set_context(test_idx=None)
+    for test_idx, (improved_algorithm_str, new_utility_val, new_utility_test) in enumerate(test_results):
+        if isinstance(improved_algorithm_str, Exception):
+            return 0
         if not improved_algorithm_str:
             continue
         # Save the improved algorithm to a file
         # First, find the most recent folder in results
         # Then, save the algorithm to that folder
         time_elapsed = int(eval_idx) - int(run_id.split("_")[0])
-        write_str_to_file(base_algorithm_str, f"results/{run_id}/base_algorithm_{time_elapsed}_{test_idx}.py")
-        write_str_to_file(improved_algorithm_str, f"results/{run_id}/improved_algorithm_{time_elapsed}_{test_idx}.py")
-        utility.uses = 0
-        utility_wrapped = create_handled_fn(utility, handle_exceptions, log_usage, None, fail_value=0)
-        new_utility_val = utility_wrapped(improved_algorithm_str, mode="val")
-        if isinstance(new_utility_val, Exception):
-            return 0
-        # Also log test
+        save_test_algorithms(
+            run_id, test_idx, f"{time_elapsed}_{test_idx}", base_algorithm_str, improved_algorithm_str,
+            {"utility_val": new_utility_val, "utility_test": new_utility_test if log_usage else None},
+        )
         if log_usage:
-            print("Evaluating improved algorithm on test")
-            utility.uses = 0
-            utility_wrapped = create_handled_fn(utility, handle_exceptions, log_usage, None, fail_value=0)
-            new_utility_test = utility_wrapped(improved_algorithm_str, mode="test")
-            if isinstance(new_utility_test, Exception):
-                return 0
             expected_utility_test += new_utility_test / n_tests
         expected_utility_val += new_utility_val / n_tests
     if log_usage:
@@ -140,4 +214,10 @@ def meta_utility(improve_str: str, mode: str = "val", log_usage: bool = False, h
 # We're in secret_utility.py - we want the string of utility.py
 fake_self_str = read_file_as_str(f"tasks/{config['task']}/utility.py")
 meta_utility.budget = config['meta_utility_budget']
-meta_utility.str = fake_self_str
\ No newline at end of file
+meta_utility.str = fake_self_str
+meta_utility.target = ("improve_algorithm", 3)
+# Meta-utility tests share this module's state, so improvers are evaluated one at a time
+meta_utility.batch = lambda improve_strs, mode="val": batch_evaluate(meta_utility, improve_strs, mode, max_parallel=1)
+meta_utility.race = lambda improve_strs, mode="val": race_evaluate(meta_utility, improve_strs, mode, max_parallel=1)
+if config['meta_utility_parallel']:
+    start_meta_utility_pool()
\ No newline at end of file
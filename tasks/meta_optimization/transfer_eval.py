@@ -10,7 +10,7 @@ from tqdm import tqdm
 from config import config
 from helpers import (
     read_file_as_str, generate_seed_algorithm, write_str_to_file,
-    temp_override
+    temp_override, save_test_algorithms
 )
 
 # Suppress warnings
@@ -152,8 +152,7 @@ for subtask in subtasks:
             # First, find the most recent folder in results
             # Then, save the algorithm to that folder
             time_elapsed = int(eval_idx) - int(run_id.split("_")[0])
-            write_str_to_file(base_algorithm_str, f"results/{run_id}/base_algorithm_{time_elapsed}_{test_idx}.py")
-            write_str_to_file(improved_algorithm_str, f"results/{run_id}/improved_algorithm_{time_elapsed}_{test_idx}.py")
+            save_test_algorithms(run_id, test_idx, f"{time_elapsed}_{test_idx}", base_algorithm_str, improved_algorithm_str)
             print("Evaluating improved algorithm on val")
             try:
                 utility.uses = 0
@@ -1,9 +1,16 @@
 import numpy as np
-from pebble import ThreadPool
-from helpers import temp_override
-import time
+from helpers import temp_override, batch_evaluate, race_evaluate
+from worker_pool import worker_pool
+from instance_bank import get_instances, capture_random_states, get_random_states, select_instances
 
-def utility(algorithm_str: str, mode: str = "val"):
+def generate_instance(seed, n):
+    np.random.seed(seed)  # Consistent seeding for evaluation
+    F = np.random.rand(n, n)
+    D = np.random.rand(n, n)
+    P = np.random.rand(n, n)
+    return {"F": F, "D": D, "P": P, **capture_random_states(python=False)}
+
+def utility(algorithm_str: str, mode: str = "val", instance_range=None):
     """
     Implements the Modified Quadratic Assignment Problem (MQAP) with n facilities/locations.
     Returns the objective value, where higher is better.
@@ -25,26 +32,31 @@ def utility(algorithm_str: str, mode: str = "val"):
     lambda_value = 0.5  # Preference weight
     average_objective = 0
     base_seed = 4321 if mode == "val" else 5678
-    pool = ThreadPool()
     eps = 1e-2
     scale = n * n
 
     try:
-        algorithm = temp_override(algorithm_str, "algorithm")
+        temp_override(algorithm_str, "algorithm", in_worker=True)
     except:
         return eps
 
-    for test_idx in range(n_tests):
-        np.random.seed(base_seed + test_idx)  # Consistent seeding for evaluation
-        F = np.random.rand(n, n)
-        D = np.random.rand(n, n)
-        P = np.random.rand(n, n)
+    params = {"base_seed": base_seed, "n_tests": n_tests, "n": n}
+    instances = get_instances("modified_quadratic_assignment", params, lambda: [
+        generate_instance(base_seed + test_idx, n) for test_idx in range(n_tests)
+    ])
+    _, instances = select_instances(instances, instance_range)
+    n_tests = len(instances)
+    for instance in instances:
+        random_states = get_random_states(instance)
+        F, D, P = instance["F"], instance["D"], instance["P"]
         
         try:
-            start_time = time.time()
-            assignment_future = pool.schedule(algorithm, (F, D, P))
-            assignment = assignment_future.result(timeout=0.5)
-            total_time = time.time() - start_time
+            assignment, total_time = worker_pool.run_timed(
+                algorithm_str, "algorithm", (F, D, P), budget=0.5, clock="process_cpu",
+                random_states=random_states
+            )
+            if total_time > 0.5:
+                raise TimeoutError("algorithm exceeded its time budget")
 
             if set(assignment) == set(range(n)):
                 objective = sum(F[i, j] * D[assignment[i], assignment[j]] for i in range(n) for j in range(n))
@@ -62,7 +74,12 @@ def utility(algorithm_str: str, mode: str = "val"):
 from config import config
 from helpers import read_file_as_str
 import os
+# Not memoized: the objective includes the CPU time of the algorithm, so scores vary between runs
 utility.budget = config["utility_budget"]
 fake_self_str = read_file_as_str(f"tasks/modified_quadratic_assignment/utility.py")
 utility.str = fake_self_str
-utility.uses = 0
\ No newline at end of file
+utility.uses = 0
+utility.batch = lambda algorithm_strs, mode="val": batch_evaluate(utility, algorithm_strs, mode)
+utility.n_instances = {"val": 10, "test": 10}
+utility.target = ("algorithm", 3)
+utility.race = lambda algorithm_strs, mode="val": race_evaluate(utility, algorithm_strs, mode)
\ No newline at end of file
@@ -1,11 +1,21 @@
 import random
-import time
 import numpy as np
-from pebble import ThreadPool
-from helpers import temp_override, read_file_as_str
+from helpers import temp_override, read_file_as_str, batch_evaluate, race_evaluate
+from worker_pool import worker_pool
+from instance_bank import get_instances, capture_random_states, get_random_states, select_instances
+from utility_memo import memoize_utility
 from config import config
 
-def utility(algorithm_str: str, mode: str = "val"):
+def generate_instance(seed, max_length, alphabet):
+    np.random.seed(seed)
+    random.seed(seed)
+    length = random.randint(1, max_length)
+    t = "".join(random.choice(alphabet) for _ in range(length))
+    s = "".join(random.choice(alphabet) for _ in range(length))
+    dist = grid_dist(s, t)
+    return {"t": np.frombuffer(t.encode(), dtype=np.uint8), "dist": np.array(dist), **capture_random_states()}
+
+def utility(algorithm_str: str, mode: str = "val", instance_range=None):
     """
     Implements the str_grid_dist task. Returns a value between -1 and 1.
     """
@@ -19,37 +29,37 @@ def utility(algorithm_str: str, mode: str = "val"):
     # utility.uses = uses + 1
 
     base_seed = 4321 if mode == "val" else 5678
-    pool = ThreadPool()
     try:
-        algorithm = temp_override(algorithm_str, "algorithm")
+        temp_override(algorithm_str, "algorithm", in_worker=True)
     except:
-        pool.stop()
-        if config['join_pools']:
-            pool.join()
         return 0.0
 
     scores = []    
-    for test_idx in range(50):
-        np.random.seed(base_seed + test_idx)
-        random.seed(base_seed + test_idx)
-        length = random.randint(1, 30)
-        t = "".join(random.choice("AB") for _ in range(length))
-        s = "".join(random.choice("AB") for _ in range(length))
-        dist = grid_dist(s, t)
+    n_tests = 50
+    max_length = 30
+    alphabet = "AB"
+    params = {"base_seed": base_seed, "n_tests": n_tests, "max_length": max_length, "alphabet": alphabet}
+    instances = get_instances("str_grid_dist", params, lambda: [
+        generate_instance(base_seed + test_idx, max_length, alphabet) for test_idx in range(n_tests)
+    ])
+    _, instances = select_instances(instances, instance_range)
+    for instance in instances:
+        random_states = get_random_states(instance)
+        t = bytes(instance["t"]).decode()
+        dist = int(instance["dist"])
 
         # Because algorithm is a string, we can't call it directly. Instead, we can use eval to evaluate it as a Python expression.
         try:
-            timeout = 1
-            predictions_future = pool.schedule(score_test, (t, dist, algorithm))
-            predictions = predictions_future.result(timeout=timeout)
+            find_at_dist = lambda t, dist, max_time: worker_pool.run_timed(
+                algorithm_str, "algorithm", (t, dist), budget=max_time, clock="process_cpu",
+                random_states=random_states
+            )
+            predictions = score_test(t, dist, find_at_dist)
             scores.append(predictions)
         except Exception as e:
             print("Exception in utility:", e)
             print(e.__class__.__name__)
             scores.append(0.0)
-    pool.stop()
-    if config['join_pools']:
-        pool.join()
     return sum(scores) / len(scores)
         
 def grid_dist(s: str, t: str):
@@ -61,11 +71,11 @@ def grid_dist(s: str, t: str):
 
 
 def score_test(t: str, dist: int, find_at_dist: callable, max_time=0.1) -> float:
-    start_time = time.time()        
+    """find_at_dist(t, dist, max_time) returns the string it found and the seconds it took."""
     try:
-        s = find_at_dist(t, dist)
+        s, elapsed = find_at_dist(t, dist, max_time)
         d = grid_dist(s, t)
-        if time.time() - start_time > max_time:
+        if elapsed > max_time:
             return 0
         if d == dist:
             return 1.0  # perfect!
@@ -74,8 +84,13 @@ def score_test(t: str, dist: int, find_at_dist: callable, max_time=0.1) -> float
     except:
         return 0  # error
 
+utility = memoize_utility(utility, "str_grid_dist", read_file_as_str(f"tasks/str_grid_dist/secret_utility.py"))
 utility.budget = config["utility_budget"]
 # get the name of the file's directory
 fake_self_str = read_file_as_str(f"tasks/str_grid_dist/utility.py")
 utility.str = fake_self_str
-utility.uses = 0
\ No newline at end of file
+utility.uses = 0
+utility.batch = lambda algorithm_strs, mode="val": batch_evaluate(utility, algorithm_strs, mode)
+utility.n_instances = {"val": 50, "test": 50}
+utility.target = ("algorithm", 2)
+utility.race = lambda algorithm_strs, mode="val": race_evaluate(utility, algorithm_strs, mode)
\ No newline at end of file
@@ -1,13 +1,18 @@
-from pebble import ThreadPool
 from tqdm import tqdm
-from helpers import temp_override
+from helpers import temp_override, batch_evaluate, race_evaluate
+from worker_pool import worker_pool
+from instance_bank import get_instances, capture_random_states, get_random_states, select_instances
+from utility_memo import memoize_utility
 import numpy as np
 import random
-import time
 from helpers import read_file_as_str
 
 def generate_3sat_formula(n, m):
-    """Generate a random 3-SAT formula with n variables and m clauses."""
+    """
+    Generate a random 3-SAT formula with n variables and m clauses, as an (m, 3) array of literals.
+    Clauses are still drawn one at a time so that the formulas for existing seeds don't change;
+    they are generated once per instance bank.
+    """
     formula = []
     valid_assignment = [False] + [random.random() < 0.5 for _ in range(n)]
     for _ in range(m ** 2):
@@ -19,13 +24,72 @@ def generate_3sat_formula(n, m):
         if len(formula) == m:
             break
     random.shuffle(formula)
-    return formula
+    return np.array(formula, dtype=np.int64).reshape(-1, 3)
+
+def generate_instance(seed, min_n, max_n, clause_ratio):
+    random.seed(seed)  # Consistent seeding for evaluation
+    n = random.randint(min_n, max_n)
+    m = int(clause_ratio * n)  # Number of clauses
+    formula = generate_3sat_formula(n, m)
+    return {"formula": formula, **capture_random_states(numpy=False)}
+
+def evaluate_literals(formula, assignment):
+    """
+    Evaluates each literal of an (m, 3) formula as (assignment[abs(lit)] > 0) == (lit > 0).
+    Lists, tuples and arrays are evaluated in one vectorized pass; other assignments, such as dicts,
+    literal by literal. Only the variables the formula uses are looked up, as before.
+    """
+    formula = np.asarray(formula).reshape(-1, 3)
+    variables = np.abs(formula)
+    if isinstance(assignment, (list, tuple, np.ndarray)):
+        assignment_array = np.asarray(assignment)
+        if assignment_array.ndim == 1:
+            return (assignment_array[variables] > 0) == (formula > 0)
+    values = [[assignment[var] > 0 for var in clause] for clause in variables.tolist()]
+    return np.array(values, dtype=bool).reshape(formula.shape) == (formula > 0)
 
 def check_3sat_formula(formula, assignment):
-    success = all(any((assignment[abs(lit)] > 0) == (lit > 0) for lit in clause) for clause in formula)
-    return success
+    """Returns whether the assignment satisfies every clause of the formula."""
+    return bool(np.all(np.any(evaluate_literals(formula, assignment), axis=1)))
+
+def count_satisfied_clauses(formula, assignment):
+    """Returns the number of clauses of the formula the assignment satisfies, for partial-credit scoring."""
+    return int(np.sum(np.any(evaluate_literals(formula, assignment), axis=1)))
 
-def utility(algorithm_str: str, mode: str = "val"):
+def check_3sat_assignments(formula, assignments, count=False):
+    """
+    Checks a batch of assignments against a formula at once.
+
+    The assignments are bit-packed per variable into uint64 words, one bit per assignment, so each
+    clause is checked for 64 assignments at a time with a few bitwise operations.
+
+    Args:
+        formula: An (m, 3) array-like of literals.
+        assignments: A (k, n + 1) array-like of truth values, indexed by variable.
+        count (bool): Whether to count satisfied clauses instead of checking all of them.
+
+    Returns:
+        A (k,) bool array of which assignments satisfy the formula, or with count=True,
+        an int array of how many clauses each one satisfies.
+    """
+    formula = np.asarray(formula).reshape(-1, 3)
+    assignments = np.asarray(assignments) > 0
+    n_assignments, n_vars = assignments.shape
+    n_words = -(-n_assignments // 64)
+    padded = np.zeros((n_vars, n_words * 64), dtype=bool)
+    padded[:, :n_assignments] = assignments.T
+    # packed[var, word] has bit b set if assignment 64 * word + b sets var
+    packed = np.packbits(padded.reshape(n_vars, n_words, 64), axis=2, bitorder="little").view("<u8").reshape(n_vars, n_words)
+    literal_bits = packed[np.abs(formula)]
+    literal_bits = np.where((formula > 0)[:, :, None], literal_bits, ~literal_bits)
+    clause_bits = literal_bits[:, 0] | literal_bits[:, 1] | literal_bits[:, 2]
+    if count:
+        clause_satisfied = np.unpackbits(clause_bits.view(np.uint8).reshape(len(formula), -1), axis=1, bitorder="little")
+        return clause_satisfied[:, :n_assignments].sum(axis=0)
+    satisfied_bits = np.bitwise_and.reduce(clause_bits, axis=0, initial=np.uint64(2 ** 64 - 1))
+    return np.unpackbits(satisfied_bits.view(np.uint8), bitorder="little")[:n_assignments].astype(bool)
+
+def utility(algorithm_str: str, mode: str = "val", instance_range=None):
     """
     Implements the Random 3-SAT problem with n variables and m clauses.
     Returns the fraction of formulas solved successfully within the time limit.
@@ -45,37 +109,34 @@ def utility(algorithm_str: str, mode: str = "val"):
     n_tests = 30
     min_n = 5  # Min number of variables
     max_n = 50  # Max number of variables
+    clause_ratio = 4  # Clauses per variable (change it to adjust difficulty)
     solved_count = 0
     base_seed = 4321 if mode == "val" else 5678
     timeout = 0.1
     eps = 1e-2
-    join_pool = False
-    
-    pool = ThreadPool()
 
     try:
-        algorithm = temp_override(algorithm_str, "algorithm")
+        temp_override(algorithm_str, "algorithm", in_worker=True)
     except:
-        pool.stop()
-        if join_pool:
-            pool.join()
         return eps
 
+    params = {"base_seed": base_seed, "n_tests": n_tests, "min_n": min_n, "max_n": max_n, "clause_ratio": clause_ratio}
+    instances = get_instances("three_sat", params, lambda: [
+        generate_instance(base_seed + test_idx, min_n, max_n, clause_ratio) for test_idx in range(n_tests)
+    ])
+    _, instances = select_instances(instances, instance_range)
+    n_tests = len(instances)
     for test_idx in tqdm(range(n_tests)):
-        random.seed(base_seed + test_idx)  # Consistent seeding for evaluation
-        n = random.randint(min_n, max_n)
-        m = int(4 * n)  # Number of clauses (change 4 to a different number to adjust difficulty)
-        formula = generate_3sat_formula(n, m)
+        instance = instances[test_idx]
+        random_states = get_random_states(instance)
+        formula = instance["formula"]
         try:
-            formula_copy = formula.copy()
-            time_start = time.time()
-            if isinstance(pool, ThreadPool):
-                assignment_future = pool.schedule(algorithm, (formula_copy,))
-            else:
-                assignment_future = pool.schedule(algorithm, (formula_copy,), timeout=timeout)
-            assignment = assignment_future.result(timeout=timeout)
-            time_end = time.time()
-            if time_end - time_start > timeout:
+            formula_copy = formula.tolist()
+            assignment, elapsed = worker_pool.run_timed(
+                algorithm_str, "algorithm", (formula_copy,), budget=timeout, clock="process_cpu",
+                random_states=random_states
+            )
+            if elapsed > timeout:
                 solved_count += eps
                 continue
             # Validate the solution
@@ -85,20 +146,21 @@ def utility(algorithm_str: str, mode: str = "val"):
                 solved_count += eps
         except Exception as e:
             if not isinstance(e, TimeoutError):
-                pool.stop()
                 return eps
 
-    pool.stop()
-    if join_pool:
-        pool.join()
     print(f"average_correct: {solved_count / n_tests}")
     return max(solved_count / n_tests, eps)
 
 from config import config
 from helpers import read_file_as_str
 import os
+utility = memoize_utility(utility, "three_sat", read_file_as_str(f"tasks/three_sat/secret_utility.py"))
 utility.budget = config["utility_budget"]
 # get the name of the file's directory
 fake_self_str = read_file_as_str(f"tasks/three_sat/utility.py")
 utility.str = fake_self_str
-utility.uses = 0
\ No newline at end of file
+utility.uses = 0
+utility.batch = lambda algorithm_strs, mode="val": batch_evaluate(utility, algorithm_strs, mode)
+utility.n_instances = {"val": 30, "test": 30}
+utility.target = ("algorithm", 1)
+utility.race = lambda algorithm_strs, mode="val": race_evaluate(utility, algorithm_strs, mode)
\ No newline at end of file
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+# Bound at import, since reliability_guard later disables it in the improver process
+replace_file = os.replace
+
+class Metric:
+    def __init__(self, registry, name, help, kind):
+        """
+        A counter or gauge, with one value per combination of labels. The labels of a series are the ones
+        given when updating it plus the registry's context, so metrics are attributed to the current run.
+        """
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+
+    def series_key(self, labels):
+        return tuple(sorted((name, str(value)) for name, value in {**self.registry.context, **labels}.items()))
+
+    def inc(self, value=1, **labels):
+        key = self.series_key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, value, **labels):
+        key = self.series_key(labels)
+        with self.registry.lock:
+            self.values[key] = value
+
+    def snapshot_series(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+    def merge_series(self, series):
+        for entry in series:
+            key = tuple(sorted(entry["labels"].items()))
+            if self.kind == "counter":
+                self.values[key] = self.values.get(key, 0) + entry["value"]
+            else:
+                self.values[key] = entry["value"]
+
+    def prometheus_lines(self):
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+class Histogram(Metric):
+    def __init__(self, registry, name, help, buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)):
+        """
+        Counts observations in buckets, Prometheus-style: bucket i counts observations up to buckets[i],
+        and the last count is for the ones above every bucket.
+        """
+        super().__init__(registry, name, help, "histogram")
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self.series_key(labels)
+        with self.registry.lock:
+            series = self.values.setdefault(key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0})
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot_series(self):
+        return [
+            {"labels": dict(key), "buckets": self.buckets + [float("inf")], **series, "counts": list(series["counts"])}
+            for key, series in self.values.items()
+        ]
+
+    def merge_series(self, series):
+        for entry in series:
+            key = tuple(sorted(entry["labels"].items()))
+            merged = self.values.setdefault(key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0})
+            merged["counts"] = [count + other for count, other in zip(merged["counts"], entry["counts"])]
+            merged["sum"] += entry["sum"]
+            merged["count"] += entry["count"]
+
+    def prometheus_lines(self):
+        lines = []
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], series["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series['count']}")
+        return lines
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+class Registry:
+    def __init__(self):
+        """
+        In-process registry of metrics, exported as Prometheus text or as JSONL snapshots.
+        The context (e.g. run_id, iteration and test_idx) is added to the labels of every update, process-wide,
+        so that threads serving a call are attributed to it too.
+        """
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.context = {}
+
+    def get_metric(self, metric_class, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(self, name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.get_metric(Metric, name, help, kind="counter")
+
+    def gauge(self, name, help):
+        return self.get_metric(Metric, name, help, kind="gauge")
+
+    def histogram(self, name, help, **kwargs):
+        return self.get_metric(Histogram, name, help, **kwargs)
+
+    def set_context(self, **labels):
+        """Sets (or, with a value of None, removes) labels added to every update from now on."""
+        for name, value in labels.items():
+            if value is None:
+                self.context.pop(name, None)
+            else:
+                self.context[name] = value
+
+    def reset(self):
+        """Clears every series, e.g. in a worker process whose snapshot is merged into its parent's registry."""
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "pid": os.getpid(),
+                "context": dict(self.context),
+                "metrics": {
+                    name: {"kind": metric.kind, "help": metric.help, "series": metric.snapshot_series()}
+                    for name, metric in self.metrics.items()
+                },
+            }
+
+    def merge(self, snapshot):
+        """Adds the counters and histograms of a snapshot (e.g. from a worker process) to this registry."""
+        for name, metric_snapshot in snapshot["metrics"].items():
+            if metric_snapshot["kind"] == "histogram":
+                buckets = metric_snapshot["series"][0]["buckets"][:-1] if metric_snapshot["series"] else ()
+                metric = self.histogram(name, metric_snapshot["help"], buckets=buckets)
+            else:
+                metric = self.get_metric(Metric, name, metric_snapshot["help"], kind=metric_snapshot["kind"])
+            with self.lock:
+                metric.merge_series(metric_snapshot["series"])
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append(f"# HELP {name} {metric.help}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+                lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path):
+        """Appends a snapshot of every metric to a JSONL file."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as writer:
+            writer.write(json.dumps(self.snapshot()) + "\n")
+
+    def write_prometheus(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as writer:
+            writer.write(self.to_prometheus())
+        replace_file(temp_path, path)
+
+registry = Registry()
@@ -0,0 +1,51 @@
+import time
+import numpy as np
+
+clocks = {
+    "wall": time.perf_counter_ns,
+    "process_cpu": time.process_time_ns,
+    "thread_cpu": time.thread_time_ns,
+}
+
+clock_overhead = None
+
+def read_clocks():
+    return [clock() for clock in clocks.values()]
+
+def calibrate_overhead(n_samples=1000):
+    """
+    Measures how long timing an empty call takes on this machine, in seconds per clock.
+    The median is used so that a few preempted samples don't inflate the baseline.
+    """
+    noop = lambda: None
+    samples = []
+    for _ in range(n_samples):
+        start = read_clocks()
+        noop()
+        end = read_clocks()
+        samples.append([e - s for s, e in zip(start, end)])
+    medians = np.median(np.array(samples), axis=0) / 1e9
+    return dict(zip(clocks, medians.tolist()))
+
+def get_clock_overhead():
+    """Returns the overhead baseline, calibrating it once per process."""
+    global clock_overhead
+    if clock_overhead is None:
+        clock_overhead = calibrate_overhead()
+    return clock_overhead
+
+def timed_call(fn, args):
+    """
+    Calls fn(*args) and measures it with every clock.
+
+    Returns:
+        result: The return value of fn.
+        timings (dict): The seconds elapsed per clock, minus the overhead baseline. CPU clocks count
+            only time spent in this process (or thread), so they are unaffected by other load on the machine.
+    """
+    overhead = get_clock_overhead()
+    start = read_clocks()
+    result = fn(*args)
+    end = read_clocks()
+    timings = {name: max((e - s) / 1e9 - overhead[name], 0.0) for name, s, e in zip(clocks, start, end)}
+    return result, timings
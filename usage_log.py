@@ -0,0 +1,147 @@
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
+import hashlib
+import threading
+import traceback
+from config import config
+
+# Bound at import, since reliability_guard later disables them in the improver process
+replace_file, rename_file, remove_file = os.replace, os.rename, os.remove
+
+class UsageLog:
+    def __init__(self, path="usage_log.jsonl", prompt_dir="usage_log_prompts", flush_interval=1.0,
+                 max_bytes=64 * 1024 ** 2, max_age=24 * 60 * 60, compress=True):
+        """
+        Log of language model calls, written by a background thread in batches so that logging stays off the request path.
+
+        Prompts are stored once each in prompt_dir, named by their hash, and log records only refer to them,
+        so repeating the same long prompt (e.g. one including the utility source) adds a few bytes per call.
+        The log is rotated to path.<timestamp> once it is larger than max_bytes or older than max_age seconds.
+
+        Args:
+            path (str): The path of the log.
+            prompt_dir (str): The directory of the prompts the log refers to.
+            flush_interval (float): The most seconds a record waits in memory before it is written.
+            max_bytes (int): The size above which the log is rotated.
+            max_age (float): The age, in seconds, above which the log is rotated.
+            compress (bool): Whether to gzip rotated logs and stored prompts.
+        """
+        self.path = path
+        self.prompt_dir = prompt_dir
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+        self.stored_prompts = set()
+        self.opened_at = None
+
+    def ensure_started(self):
+        """Starts the writer thread, once per process (threads don't survive forks)."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            self.stored_prompts = set()
+            self.opened_at = None
+            threading.Thread(target=self.write_loop, args=(self.queue,), daemon=True).start()
+            if self.pid is None:
+                atexit.register(self.flush)
+            self.pid = os.getpid()
+
+    @staticmethod
+    def prompt_ref(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def log(self, role, message, **fields):
+        """Queues a record of a call, with the role and message stored by reference, and returns immediately."""
+        self.ensure_started()
+        prompts = {self.prompt_ref(role): role, self.prompt_ref(message): message}
+        record = [time.time(), {"role": self.prompt_ref(role), "message": self.prompt_ref(message), **fields}]
+        self.queue.put((record, prompts))
+
+    def flush(self):
+        """Waits until every queued record is written."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def write_loop(self, records):
+        while True:
+            batch = [records.get()]
+            deadline = time.time() + self.flush_interval
+            while time.time() < deadline:
+                try:
+                    batch.append(records.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                print("Failed to write to usage log with exception", e)
+                print("Traceback:", traceback.format_exc())
+            for _ in batch:
+                records.task_done()
+
+    def write_batch(self, batch):
+        with self.lock:
+            for _, prompts in batch:
+                for ref, text in prompts.items():
+                    self.store_prompt(ref, text)
+            # Opened per batch, so that rotations by other processes are picked up
+            with open(self.path, "a") as writer:
+                writer.write("".join(json.dumps(record) + "\n" for record, _ in batch))
+            if self.opened_at is None:
+                self.opened_at = time.time()
+            if os.path.getsize(self.path) > self.max_bytes or time.time() - self.opened_at > self.max_age:
+                self.rotate_locked()
+
+    def store_prompt(self, ref, text):
+        if ref in self.stored_prompts:
+            return
+        prompt_path = os.path.join(self.prompt_dir, ref + (".txt.gz" if self.compress else ".txt"))
+        if not os.path.exists(prompt_path):
+            os.makedirs(self.prompt_dir, exist_ok=True)
+            # Written under a temporary name, so that other processes never see a partial prompt
+            temp_path = f"{prompt_path}.{os.getpid()}.tmp"
+            with (gzip.open(temp_path, "wt") if self.compress else open(temp_path, "w")) as writer:
+                writer.write(text)
+            replace_file(temp_path, prompt_path)
+        self.stored_prompts.add(ref)
+
+    def rotate(self):
+        """Writes out queued records and moves the current log aside, so that the next record starts a new one."""
+        self.flush()
+        with self.lock:
+            self.rotate_locked()
+
+    def rotate_locked(self):
+        rotated_path = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}"
+        try:
+            rename_file(self.path, rotated_path)
+        except FileNotFoundError:
+            # Nothing logged yet, or another process rotated it first
+            return
+        finally:
+            self.opened_at = None
+        if self.compress:
+            with open(rotated_path, "rb") as reader, gzip.open(rotated_path + ".gz", "wb") as writer:
+                shutil.copyfileobj(reader, writer)
+            remove_file(rotated_path)
+
+usage_log = UsageLog(
+    config['usage_log_path'],
+    config['usage_log_prompt_dir'],
+    flush_interval=config['usage_log_flush_interval'],
+    max_bytes=config['usage_log_max_bytes'],
+    max_age=config['usage_log_max_age'],
+    compress=config['usage_log_compress'],
+)
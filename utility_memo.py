@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import functools
+import threading
+from config import config
+from worker_pool import worker_pool
+from helpers import count_use, reserved_use
+from instance_bank import BANK_FORMAT_VERSION
+
+class UtilityMemo:
+    def __init__(self, path="cache/utility_memo.sqlite"):
+        """
+        Persistent store of utility scores, shared by all processes (and resumed runs) using the same path.
+        Each score is stored with how long the evaluation took and when it was made.
+
+        Args:
+            path (str): The path of the SQLite database.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        """Opens the database, once per process (connections can't be shared across forks)."""
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, score TEXT, metadata TEXT)")
+        self.connection = connection
+        self.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def make_key(task, utility_source, algorithm_str, mode):
+        """Keys a score by everything it depends on: the task, utility and instance bank versions, the algorithm and the mode."""
+        utility_hash = hashlib.sha256(utility_source.encode()).hexdigest()
+        algorithm_hash = hashlib.sha256(algorithm_str.encode()).hexdigest()
+        return f"{task}:{utility_hash}:{BANK_FORMAT_VERSION}:{algorithm_hash}:{mode}"
+
+    def get(self, key):
+        """Returns the score stored for the key, or None."""
+        with self.lock:
+            row = self.connect().execute("SELECT score FROM memo WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, score, metadata):
+        with self.lock:
+            self.connect().execute(
+                "INSERT OR REPLACE INTO memo VALUES (?, ?, ?)", (key, json.dumps(score), json.dumps(metadata))
+            )
+
+utility_memo = UtilityMemo(config['utility_memo_path'])
+
+def memoize_utility(utility, task, utility_source, counts_uses=False):
+    """
+    Wraps a task utility so that scores are looked up in utility_memo before evaluating, if config['use_utility_memo'] is set.
+
+    A memo hit counts as a use exactly when the utility would have counted the call: if counts_uses, every call
+    is counted here (see helpers.count_use) and misses run the utility without counting it again; once the budget
+    is spent, calls go to the utility itself, so that it applies its own budget handling exactly as without the memo.
+    Otherwise hits, like misses, leave utility.uses alone.
+    Attributes like budget, uses and str belong on the wrapper: the utility reads them through its module global,
+    which is rebound to the wrapper.
+    Only scores computed without any failed worker call (see WorkerPool.failure_count) are stored, since timeouts
+    and crashes depend on load rather than on the algorithm. Tasks whose scores depend on timing even without
+    failures shouldn't be memoized at all.
+
+    Args:
+        utility (callable): The utility function, taking algorithm_str, mode and any keyword arguments like instance_range.
+        task (str): The name of the task.
+        utility_source (str): The source of the module defining the utility, so edits invalidate its scores.
+        counts_uses (bool): Whether the utility increments its own utility.uses.
+
+    Returns:
+        The wrapped utility, or utility itself if memoization is disabled.
+    """
+    if not config['use_utility_memo']:
+        return utility
+
+    @functools.wraps(utility)
+    def memoized_utility(algorithm_str, mode="val", **kwargs):
+        if not isinstance(algorithm_str, str) or not algorithm_str:
+            return utility(algorithm_str, mode=mode, **kwargs)
+        if counts_uses and not count_use(memoized_utility):
+            return utility(algorithm_str, mode=mode, **kwargs)
+        # Scores on part of the instances (instance_range) are kept apart from full ones
+        key_mode = f"{mode}:{sorted(kwargs.items())}" if kwargs else mode
+        key = UtilityMemo.make_key(task, utility_source, algorithm_str, key_mode)
+        score = utility_memo.get(key)
+        if score is not None:
+            return score
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        failures = worker_pool.failure_count()
+        # If the utility counts its uses, this call was counted above
+        with reserved_use(memoized_utility):
+            score = utility(algorithm_str, mode=mode, **kwargs)
+        if worker_pool.failure_count() > failures:
+            return score
+        metadata = {
+            "wall_time": time.perf_counter() - start_wall,
+            "process_cpu_time": time.process_time() - start_cpu,
+            "created": time.time(),
+        }
+        utility_memo.put(key, float(score), metadata)
+        return score
+    return memoized_utility
@@ -0,0 +1,362 @@
+import os
+import time
+import atexit
+import random
+import threading
+import collections
+import numpy as np
+import multiprocess
+from multiprocess.connection import wait
+from multiprocess.reduction import ForkingPickler
+from config import config
+from timing import timed_call, get_clock_overhead
+from instance_bank import mapped_array_ref
+
+# How often the manager checks the CPU time of busy guarded workers
+CPU_CHECK_SECONDS = 0.5
+
+class Worker:
+    def __init__(self, context, guard, preload, inherited_connections):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=worker_main, args=(child_connection, guard, preload, inherited_connections)
+        )
+        self.process.start()
+        child_connection.close()
+        self.request_id = None
+        self.deadline = None
+        self.cpu_deadline = None
+
+    def memory_bytes(self):
+        """Returns the resident memory of the worker, or 0 if it can't be read."""
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except Exception:
+            return 0
+
+    def cpu_seconds(self):
+        """Returns the CPU time the worker has used, over all its threads, or 0 if it can't be read."""
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as f:
+                # After the command name, which may contain spaces; utime and stime are fields 14 and 15
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except Exception:
+            return 0.0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+def allowed_memory_limit(resource, limit):
+    """Lowers limit to the hard limits reliability_guard sets it as, since a process can't raise those."""
+    if limit is None:
+        return None
+    for rlimit in (resource.RLIMIT_AS, resource.RLIMIT_DATA, resource.RLIMIT_STACK):
+        _, hard = resource.getrlimit(rlimit)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+    return limit
+
+def worker_main(connection, guard, preload, inherited_connections):
+    """
+    Runs candidate functions sent by the manager, one at a time.
+    The most recent function is kept defined, so repeated calls don't re-run its module code.
+    A guarded worker is sandboxed before it runs anything: reliability_guard with an address space limit of
+    config['worker_memory_limit_bytes'] and an audit hook (see helpers.install_audit_hook). Its CPU time per call
+    is limited by the manager, since nothing in the worker can lift the sandbox to change its own limits.
+    """
+    from helpers import run_by_compiling, reliability_guard, install_audit_hook
+    # Otherwise the other ends would not see EOF when the manager or a sibling worker exits
+    for inherited_connection in inherited_connections:
+        inherited_connection.close()
+    if guard:
+        # Imported first, since reliability_guard hides it from the candidates
+        import resource
+        reliability_guard(maximum_memory_bytes=allowed_memory_limit(resource, config['worker_memory_limit_bytes']))
+        install_audit_hook()
+    fn_key, fn = None, None
+    if preload is not None:
+        try:
+            fn = run_by_compiling(*preload)
+            fn_key = preload
+        except Exception:
+            # Reported when the function is actually called
+            pass
+    while True:
+        try:
+            request = ForkingPickler.loads(connection.recv_bytes())
+        except EOFError:
+            return
+        define_fn_str, base_name, args, (random_state, np_random_state) = request
+        try:
+            if fn_key != (define_fn_str, base_name):
+                fn_key, fn = None, None
+                fn = run_by_compiling(define_fn_str, base_name)
+                fn_key = (define_fn_str, base_name)
+            if args is None:
+                # Only asked to define it (see WorkerPool.define)
+                connection.send_bytes(ForkingPickler.dumps(("result", None, None)))
+                continue
+            # The candidate sees the same randomness as if it were called in the caller's process
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+            response = ("result", *timed_call(fn, args))
+        except BaseException as e:
+            response = ("exception", e, None)
+        try:
+            response_bytes = ForkingPickler.dumps(response)
+        except Exception as e:
+            response_bytes = ForkingPickler.dumps(("exception", Exception(f"Failed to send back the {response[0]}: {e!r}"), None))
+        connection.send_bytes(response_bytes)
+
+def manager_main(connection, client_connection, n_workers, max_worker_memory_bytes, guard_workers):
+    """
+    Dispatches calls to workers in order and enforces their deadlines.
+    Workers are forked as concurrent calls need them, up to n_workers. A worker that misses its deadline is killed rather than left running,
+    and so is a guarded worker whose call uses more than config['worker_cpu_limit_seconds'] of CPU time over all its threads
+    (read from /proc every CPU_CHECK_SECONDS, so only enforced where it exists). One whose memory grows
+    past max_worker_memory_bytes is replaced after its call. Replacements define the latest candidate
+    before they are needed, so they start warm.
+    """
+    client_connection.close()
+    cpu_limit = config['worker_cpu_limit_seconds']
+    # Calibrated once here, so that workers inherit the baseline instead of each measuring it
+    get_clock_overhead()
+    context = multiprocess.get_context("fork")
+    preload = None
+    idle_workers = []
+    busy_workers = {}
+    pending_requests = collections.deque()
+
+    def add_worker():
+        inherited_connections = [connection] + [worker.connection for worker in idle_workers + list(busy_workers.values())]
+        idle_workers.append(Worker(context, guard_workers, preload, inherited_connections))
+
+    def reply(request_id, response_bytes):
+        connection.send((request_id, response_bytes))
+
+    def replace(worker):
+        worker.kill()
+        add_worker()
+
+    add_worker()
+    while True:
+        while pending_requests and (idle_workers or len(busy_workers) < n_workers):
+            if not idle_workers:
+                add_worker()
+            request_id, timeout, request_bytes = pending_requests.popleft()
+            worker = idle_workers.pop()
+            worker.connection.send_bytes(request_bytes)
+            worker.request_id = request_id
+            worker.deadline = time.monotonic() + timeout if timeout is not None else float("inf")
+            worker.cpu_deadline = float("inf")
+            if guard_workers and cpu_limit is not None:
+                worker.cpu_deadline = worker.cpu_seconds() + cpu_limit
+            busy_workers[worker.connection] = worker
+        wait_timeout = None
+        if busy_workers:
+            next_deadline = min(worker.deadline for worker in busy_workers.values())
+            if any(worker.cpu_deadline != float("inf") for worker in busy_workers.values()):
+                next_deadline = min(next_deadline, time.monotonic() + CPU_CHECK_SECONDS)
+            if next_deadline != float("inf"):
+                wait_timeout = max(next_deadline - time.monotonic(), 0)
+        ready = wait([connection, *busy_workers], timeout=wait_timeout)
+
+        for ready_connection in ready:
+            if ready_connection is connection:
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    message = ("stop",)
+                if message[0] == "stop":
+                    for worker in idle_workers + list(busy_workers.values()):
+                        worker.kill()
+                    return
+                _, request_id, timeout, fn_key, request_bytes = message
+                preload = fn_key
+                pending_requests.append((request_id, timeout, request_bytes))
+                continue
+            worker = busy_workers.pop(ready_connection)
+            try:
+                response_bytes = worker.connection.recv_bytes()
+            except EOFError:
+                replace(worker)
+                error = Exception(f"Worker exited with code {worker.process.exitcode}")
+                response_bytes = bytes(ForkingPickler.dumps(("exception", error, None)))
+            else:
+                if worker.memory_bytes() > max_worker_memory_bytes:
+                    replace(worker)
+                else:
+                    idle_workers.append(worker)
+            reply(worker.request_id, response_bytes)
+
+        now = time.monotonic()
+        for worker_connection, worker in list(busy_workers.items()):
+            if worker.deadline <= now:
+                del busy_workers[worker_connection]
+                replace(worker)
+                reply(worker.request_id, None)
+            elif worker.cpu_deadline != float("inf") and worker.cpu_seconds() > worker.cpu_deadline:
+                del busy_workers[worker_connection]
+                replace(worker)
+                error = Exception(f"Worker exceeded its CPU time limit of {cpu_limit} seconds")
+                reply(worker.request_id, bytes(ForkingPickler.dumps(("exception", error, None))))
+
+class WorkerPool:
+    def __init__(self, n_workers, max_worker_memory_bytes, guard_workers=False):
+        """
+        Persistent pool of worker processes that run candidate functions with hard deadlines.
+
+        Unlike threads, a worker that exceeds its deadline is killed, so it can't keep using CPU
+        while later tests are timed. Workers are forked by a manager process that is started before
+        reliability_guard disables fork in this process (see temp_override); each process that calls
+        the pool gets its own manager. Calls are thread-safe.
+        Arguments that are views into instance banks are sent by reference and mapped by the worker
+        (see instance_bank.mapped_array_ref), so large instances are never copied through the pipes.
+
+        Args:
+            n_workers (int): The maximum number of workers, i.e. how many calls can run at once.
+                Defaults to the number of CPUs.
+            max_worker_memory_bytes (int): Workers whose resident memory exceeds this after a call are recycled.
+            guard_workers (bool): Whether workers are sandboxed (see worker_main) unless start says otherwise.
+        """
+        self.n_workers = n_workers or os.cpu_count()
+        self.max_worker_memory_bytes = max_worker_memory_bytes
+        self.guard_workers = guard_workers
+        self.condition = threading.Condition()
+        self.manager = None
+        self.connection = None
+        self.pid = None
+        self.request_count = 0
+        self.receiving = False
+        self.responses = {}
+        self.local = threading.local()
+
+    def failure_count(self):
+        """
+        Returns how many calls from this thread have failed so far: raised, timed out, crashed their worker
+        or went over the budget of run_timed. Scores computed across a failure may depend on timing or load.
+        """
+        return getattr(self.local, "failures", 0)
+
+    def count_failure(self):
+        self.local.failures = self.failure_count() + 1
+
+    def start(self, guard_workers=None):
+        """Starts the manager of this process, if it isn't running yet."""
+        if guard_workers is None:
+            guard_workers = self.guard_workers
+        with self.condition:
+            if self.manager is not None and self.pid == os.getpid():
+                return
+            if os.fork is None:
+                raise RuntimeError("The worker pool must be started before reliability_guard disables fork")
+            context = multiprocess.get_context("fork")
+            self.connection, manager_connection = context.Pipe()
+            self.manager = context.Process(
+                target=manager_main,
+                args=(manager_connection, self.connection, self.n_workers, self.max_worker_memory_bytes, guard_workers)
+            )
+            self.manager.start()
+            manager_connection.close()
+            if self.pid != os.getpid():
+                atexit.register(self.stop)
+            self.pid = os.getpid()
+            self.request_count = 0
+            self.responses = {}
+
+    def stop(self):
+        with self.condition:
+            if self.manager is None or self.pid != os.getpid():
+                return
+            try:
+                self.connection.send(("stop",))
+            except Exception:
+                pass
+            self.manager.join()
+            self.connection.close()
+            self.manager = None
+
+    def run(self, define_fn_str, base_name, args, timeout, random_states=None):
+        """
+        Defines base_name from define_fn_str in a worker and calls it with args.
+        The function sees random_states, the (random, np.random) states to call it with,
+        by default those of the calling process.
+
+        Returns:
+            The return value of the function.
+
+        Raises:
+            TimeoutError: If the call took longer than timeout seconds (if not None); the worker running it is killed.
+            Exception: Whatever the function raised.
+        """
+        return self.run_with_timings(define_fn_str, base_name, args, timeout, random_states)[0]
+
+    def define(self, define_fn_str, base_name, timeout=10):
+        """
+        Defines base_name from define_fn_str in a worker without calling it, so that the module code of a candidate
+        runs in the sandbox instead of this process, and leaves the worker ready to call it.
+
+        Raises:
+            TimeoutError: If defining it took longer than timeout seconds.
+            Exception: Whatever defining it raised.
+        """
+        self.run_with_timings(define_fn_str, base_name, None, timeout)
+
+    def run_timed(self, define_fn_str, base_name, args, budget, clock, random_states=None):
+        """
+        Like run, but measures the call on the given clock (see timing.clocks) and returns it
+        along with the result, so that the caller can enforce a time budget on that clock.
+        For CPU clocks, the worker is only killed once config['worker_deadline_factor'] times
+        the budget has passed in wall time, so a loaded machine doesn't turn into timeouts.
+
+        Returns:
+            result: The return value of the function.
+            elapsed (float): The seconds the call took on the clock.
+        """
+        timeout = budget if clock == "wall" else budget * config['worker_deadline_factor']
+        result, timings = self.run_with_timings(define_fn_str, base_name, args, timeout, random_states)
+        if timings[clock] > budget:
+            self.count_failure()
+        return result, timings[clock]
+
+    def run_with_timings(self, define_fn_str, base_name, args, timeout, random_states=None):
+        self.start()
+        if random_states is None:
+            random_states = (random.getstate(), np.random.get_state())
+        if args is not None:
+            args = tuple(mapped_array_ref(arg) or arg for arg in args)
+        request_bytes = bytes(ForkingPickler.dumps((define_fn_str, base_name, args, random_states)))
+        fn_key = (define_fn_str, base_name)
+        with self.condition:
+            self.request_count += 1
+            request_id = self.request_count
+            self.connection.send(("run", request_id, timeout, fn_key, request_bytes))
+            while request_id not in self.responses:
+                if self.receiving:
+                    self.condition.wait()
+                    continue
+                # Receive on behalf of every waiting thread, without blocking them from sending
+                self.receiving = True
+                self.condition.release()
+                try:
+                    response_id, response_bytes = self.connection.recv()
+                finally:
+                    self.condition.acquire()
+                    self.receiving = False
+                    self.condition.notify_all()
+                self.responses[response_id] = response_bytes
+            response_bytes = self.responses.pop(request_id)
+        if response_bytes is None:
+            self.count_failure()
+            raise TimeoutError(f"{base_name} did not finish within {timeout} seconds")
+        status, value, timings = ForkingPickler.loads(response_bytes)
+        if status == "exception":
+            self.count_failure()
+            raise value
+        return value, timings
+
+worker_pool = WorkerPool(config['worker_pool_size'], config['worker_max_memory_bytes'], config['sandbox_workers'])